@@ -22,18 +22,235 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import logging
-from .gwmqtt_client import startReceiver
-from.wmbus_interpreter import interpret
-from queue import Queue
+import sys
 import time
+import signal
+import argparse
+from queue import Queue
+
+class _PrintSink():
+
+    def write(self, result):
+        print(result)
+
+def receive(args):
+    from .gwmqtt_client import startReceiver
+    from .wmbus_interpreter import Interpreter, keys, formats
+    from .breaker import DeviceCircuitBreaker, DeadLetterStore
+    from .tracing import Tracer, finish
+    from .rollup import ConsumptionRollup
+    from .latest_index import LatestValueIndex, start_server
+    from .snapshot import StateSnapshot
+    from .sqlite_sink import SQLiteSink
+    from .file_sink import FileSink
+    from .columnar import ColumnarWriter
+    from .throttle import DeviceThrottle, parse_rules
+
+    if args.archive and args.rollup:
+        sys.exit("receive: --archive stores readings only, it cannot be combined with --rollup")
+    breaker = DeviceCircuitBreaker(args.breaker_threshold) if args.breaker_threshold else None
+    dead_letters = DeadLetterStore(args.dead_letters) if args.dead_letters else None
+    index = None
+    if args.index:
+        index = LatestValueIndex(args.index_size)
+        # a bare number is a port, anything else without colon a socket path
+        host, sep, port = args.index.rpartition(':')
+        if args.index.isdigit():
+            address = ('localhost', int(args.index))
+        else:
+            address = (host or 'localhost', int(port)) if sep else args.index
+        start_server(index, address)
+
+    throttle = DeviceThrottle(**parse_rules(args.throttle)) if args.throttle else None
+    interpreter = Interpreter(keys, formats, breaker=breaker, dead_letters=dead_letters,
+                              index=index, throttle=throttle)
+    interpreter.keys = keys
+
+    # print or store the results or, with --rollup, the closed buckets only
+    if args.sqlite:
+        store = SQLiteSink(args.sqlite)
+    elif args.archive:
+        store = ColumnarWriter(args.archive)
+    elif args.output:
+        store = FileSink(args.output, args.output_format, max_bytes=args.rotate_size << 20, max_age=args.rotate_age)
+    else:
+        store = _PrintSink()
+    sink = store
+    # stores and the rollup need scaled values and keep the registers apart
+    # by their descriptors (DIF/VIF), NDJSON output gets scaled dictionaries
+    scaled = not isinstance(store, _PrintSink)
+    descriptors = scaled and not (args.output and args.output_format == 'ndjson')
+    rollup = None
+    if args.rollup:
+        rollup = sink = ConsumptionRollup(args.rollup, args.rollup_lateness, sink)
+        descriptors = True
+
+    tracer = None
+    if args.trace_sample or args.trace_slow:
+        tracer = Tracer(args.trace_sample, args.trace_slow or None, path=args.trace_file)
+        # dump the in-memory traces on demand (kill -USR1)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.dump(args.trace_dump))
+
+    # warm restart, restore the state before telegrams are delivered
+    snapshot = None
+    if args.snapshot:
+        snapshot = StateSnapshot(args.snapshot, interpreter, rollup, args.snapshot_interval)
+        if snapshot.restore():
+            print("state restored from %s" % args.snapshot)
+        snapshot.start()
 
-if __name__ == '__main__':
     recvQueue = Queue()
-    startReceiver("192.168.1.10", 1883, 'testuser', 'testuser', recvQueue)
-    while(True):
-        time.sleep(1)
-        while not recvQueue.empty():
-            telegram = recvQueue.get()
-#            print(f"Recv: {telegram}")
-            print(interpret(telegram))
+    startReceiver(args.host, args.port, args.username, args.password, recvQueue, args.prefix, tracer)
+    try:
+        while(True):
+            time.sleep(1)
+            if snapshot is not None:
+                snapshot.poll()
+            # a failing sink must not stop the receiver
+            try:
+                if rollup is not None:
+                    rollup.flush()
+                for result in interpreter.release_throttled(scaled, descriptors):
+                    sink.write(result)
+            except Exception as e:
+                print(e)
+            while not recvQueue.empty():
+                telegram = recvQueue.get()
+#                print(f"Recv: {telegram}")
+                try:
+                    result = interpreter.interpret(telegram, scaled, descriptors)
+                    # held telegrams released by interpret() go first
+                    for released in interpreter.release_throttled(scaled, descriptors):
+                        sink.write(released)
+                    if result is not None:
+                        sink.write(result)
+                except Exception as e:
+                    print(e)
+                finish(telegram)
+    finally:
+        if snapshot is not None:
+            snapshot.stop()
+        if args.sqlite or args.archive or args.output:
+            store.close()
+
+def decode(args):
+    from .batch import decode_file
+
+    output = open(args.output, 'w') if args.output else None
+    try:
+        count, failed = decode_file(args.file, args.format, output, args.jobs, args.chunk_size, args.progress, args.scaled,
+                                    args.frame_format)
+    finally:
+        if output:
+            output.close()
+    print("%d telegrams decoded, %d failed" % (count, failed), file=sys.stderr)
+
+def bench(args):
+    from . import benchmark
+
+    if args.benchmark == 'encoding':
+        if args.file is None:
+            sys.exit("bench encoding: a capture file is required")
+        results = benchmark.load_results(args.file, args.format, descriptors=True)
+        benchmark.print_report("binary result encoding vs. JSON", benchmark.bench_encoding(results, args.rounds))
+    elif args.benchmark == 'memory':
+        report = benchmark.bench_memory(args.devices, args.frames)
+        benchmark.print_memory_report(report)
+        failures = benchmark.check_memory(report, args.max_per_device, args.max_per_frame)
+        for failure in failures:
+            print("FAILED: " + failure, file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+def simulate(args):
+    import json
+    from .simulator import LocalBroker, Simulator, SoakHarness
+
+    broker = LocalBroker()
+    simulator = Simulator(broker, args.gateways, args.meters, args.rate, args.batch_interval, args.encrypted,
+                          args.duplicates, args.zlib, prefix=args.prefix, seed=args.seed)
+    harness = SoakHarness(simulator, args.workers, args.report_interval, sys.stderr)
+    print(json.dumps(harness.run(args.duration)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='mqtt_wmbus_interpreter')
+    commands = parser.add_subparsers(dest='command')
+
+    cmd = commands.add_parser('receive', help='interpret telegrams received from gwmqtt gateways')
+    cmd.add_argument('--host', default='192.168.1.10')
+    cmd.add_argument('--port', type=int, default=1883)
+    cmd.add_argument('--username', default='testuser')
+    cmd.add_argument('--password', default='testuser')
+    cmd.add_argument('--prefix', default='gwmqtt', help='gwmqtt topic prefix')
+    cmd.add_argument('--breaker-threshold', type=int, default=5,
+                     help='consecutive failures until a device is skipped for a while (0: off)')
+    cmd.add_argument('--dead-letters', help='NDJSON file keeping samples of undecodable telegrams')
+    cmd.add_argument('--throttle', action='append', default=[], metavar='NAME=SECONDS',
+                     help='decode at most one telegram per interval of a device serial, medium (e.g. Water), '
+                          'function code (e.g. SND-IR) or default, may be repeated')
+    cmd.add_argument('--index', help='serve the latest value of every meter on [host:]port or a unix socket path')
+    cmd.add_argument('--index-size', type=int, default=1000000, help='meters kept in the latest value index')
+    cmd.add_argument('--sqlite', help='store the results in this SQLite database instead of printing them')
+    cmd.add_argument('--archive', help='write the numeric readings to columnar segments in this directory')
+    cmd.add_argument('--output', help='write the results to rotating files with this base name instead of printing them')
+    cmd.add_argument('--output-format', choices=('ndjson', 'csv'), default='ndjson')
+    cmd.add_argument('--rotate-size', type=int, default=256, help='MB after which an output file is rotated')
+    cmd.add_argument('--rotate-age', type=float, default=3600, help='seconds after which an output file is rotated')
+    cmd.add_argument('--snapshot', help='file the interpreter state is saved to and restored from on startup')
+    cmd.add_argument('--snapshot-interval', type=float, default=60, help='seconds between two snapshots')
+    cmd.add_argument('--rollup', type=float, default=0,
+                     help='print consumption buckets of this many seconds instead of every telegram')
+    cmd.add_argument('--rollup-lateness', type=float, default=60, help='seconds a bucket is kept open after its end')
+    cmd.add_argument('--trace-sample', type=int, default=0, help='trace every N-th telegram in detail (0: off)')
+    cmd.add_argument('--trace-slow', type=float, default=0, help='trace telegrams slower than this many ms (0: off)')
+    cmd.add_argument('--trace-file', help='NDJSON file the traces are appended to')
+    cmd.add_argument('--trace-dump', default='wmbus-traces.ndjson',
+                     help='file the in-memory traces are written to on SIGUSR1')
+    cmd.set_defaults(func=receive)
+
+    cmd = commands.add_parser('decode', help='decode a capture file to NDJSON')
+    cmd.add_argument('file')
+    cmd.add_argument('-f', '--format', choices=('hex', 'ndjson', 'raw'), default='hex',
+                     help='hex frame per line, gwmqtt messages per line or binary frames')
+    cmd.add_argument('-o', '--output', help='output file (default: stdout)')
+    cmd.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    cmd.add_argument('--chunk-size', type=int, default=256, help='telegrams handed to a worker at once')
+    cmd.add_argument('--progress', type=int, default=10000, help='report progress every N telegrams (0: off)')
+    cmd.add_argument('--scaled', action='store_true', help='add unit and scaled value to every record')
+    cmd.add_argument('--frame-format', choices=('A', 'B'), help='frames carry CRC blocks of the given frame format')
+    cmd.set_defaults(func=decode)
+
+    cmd = commands.add_parser('bench', help='run benchmarks')
+    cmd.add_argument('benchmark', choices=('encoding', 'memory'))
+    cmd.add_argument('file', nargs='?', help='capture file providing the telegrams (encoding)')
+    cmd.add_argument('-f', '--format', choices=('hex', 'ndjson'), default='hex')
+    cmd.add_argument('--rounds', type=int, default=5)
+    cmd.add_argument('--devices', type=int, default=100000, help='synthetic devices (memory)')
+    cmd.add_argument('--frames', type=int, default=1, help='frames retained per device (memory)')
+    cmd.add_argument('--max-per-device', type=float, help='fail if the bytes per device exceed this (memory)')
+    cmd.add_argument('--max-per-frame', type=float, help='fail if the bytes per frame exceed this (memory)')
+    cmd.set_defaults(func=bench)
+
+    cmd = commands.add_parser('simulate', help='load test the receiver with simulated gwmqtt gateways')
+    cmd.add_argument('--gateways', type=int, default=1000)
+    cmd.add_argument('--meters', type=int, default=20000)
+    cmd.add_argument('--rate', type=float, default=1000, help='telegrams per second of all gateways')
+    cmd.add_argument('--batch-interval', type=float, default=10, help='seconds between two batches of a gateway')
+    cmd.add_argument('--encrypted', type=float, default=0.0, help='share of meters sending encrypted frames')
+    cmd.add_argument('--duplicates', type=float, default=0.0, help='share of telegrams received by two gateways')
+    cmd.add_argument('--zlib', type=float, default=0.0, help='share of zlib compressed messages')
+    cmd.add_argument('--prefix', default='gwmqtt', help='gwmqtt topic prefix')
+    cmd.add_argument('--workers', type=int, default=1, help='interpreter threads')
+    cmd.add_argument('--duration', type=float, default=60, help='seconds to run')
+    cmd.add_argument('--report-interval', type=float, default=10, help='seconds between two reports on stderr')
+    cmd.add_argument('--seed', type=int, default=0)
+    cmd.set_defaults(func=simulate)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # keep the original behaviour of starting the live receiver
+        args = parser.parse_args(['receive'])
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import time
+from collections import deque
+from itertools import islice
+from functools import partial
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+
+from . import wmbus
+from .crc import frame_length
+from .wmbus_interpreter import interpret
+
+FORMAT_HEX = 'hex'
+FORMAT_NDJSON = 'ndjson'
+FORMAT_RAW = 'raw'
+
+def read_hex(f):
+    """ Yields telegrams from a text file holding one hex encoded frame per line
+
+    Empty lines and lines starting with '#' are skipped.
+    """
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield {"data": line.replace(' ', '')}
+
+def read_ndjson(f):
+    """ Yields telegrams from a file holding one JSON document per line
+
+    A line is either a complete gwmqtt message as received on the
+    <prefix>/<gw>/out topic or a single telegram object with a 'data' member.
+    Lines which are no JSON object are yielded as error results, which
+    decode_telegram() passes through.
+    """
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            payload = json.loads(line)
+        except ValueError as e:
+            yield {"error": str(e), "line": line}
+            continue
+        if not isinstance(payload, dict):
+            yield {"error": "not a JSON object", "line": line}
+        elif 'method' in payload:
+            if payload['method'] == 'wmbus':
+                for telegram in payload['params']['telegrams']:
+                    yield telegram
+        elif 'data' in payload:
+            yield payload
+
+def read_raw(f, chunk_size=1 << 16, frame_format=None):
+    """ Yields telegrams from a stream of binary frames
+
+    Frames are expected back to back, each one starting with its length
+    field. If frame_format ('A' or 'B') is given, the frames include their
+    CRC blocks. The file is read in chunks of chunk_size bytes.
+    """
+    buf = bytearray()
+    pos = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        while pos < len(buf):
+            if frame_format:
+                end = pos + frame_length(buf[pos], frame_format)
+            else:
+                end = pos + buf[pos] + 1
+            if end > len(buf):
+                break
+            yield {"data": buf[pos:end].hex()}
+            pos = end
+        del buf[:pos]
+        pos = 0
+
+    if buf:
+        print("WARNING: %d trailing bytes do not form a complete frame" % len(buf), file=sys.stderr)
+
+def json_default(value):
+    """ Serialises values json does not know about (used as json.dumps default)
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'materialise'):
+        value = value.materialise()
+        return value if isinstance(value, str) else value.hex()
+    return str(value)
+
+def decode_telegram(telegram, scaled=False, frame_format=None):
+    """ Interprets a single telegram and reports failures as result objects
+    """
+    if 'error' in telegram:
+        # unreadable input, already reported as result
+        return telegram
+    try:
+        return interpret(telegram, scaled, frame_format=frame_format)
+    except Exception as e:
+        return {"error": str(e), "telegram": telegram.get('data')}
+
+def imap_bounded(pool, func, iterable, chunk_size, window):
+    """ Yields func(item) of every item in order, computed by the pool
+
+    Unlike Pool.imap(), which reads the whole input ahead, at most window
+    chunks of chunk_size items are read and in flight at any time, so
+    memory does not grow with the size of the input.
+    """
+    items = iter(iterable)
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            pending.append(pool.map_async(func, chunk))
+        if not pending:
+            return
+        for result in pending.popleft().get():
+            yield result
+
+def _init_worker():
+    # workers must not write anything but results to the original stdout
+    wmbus.debug = 0
+    sys.stdout = sys.stderr
+
+def decode_file(path, fmt=FORMAT_HEX, output=None, jobs=None, chunk_size=256, progress=10000, scaled=False,
+                frame_format=None):
+    """ Decodes a capture file and writes NDJSON results in input order
+
+    The telegrams are interpreted by a pool of jobs worker processes
+    (defaults to the number of cores) which are fed chunk_size telegrams at
+    a time, at most two chunks per job are pending. Results are streamed
+    to output (defaults to stdout) as soon as they are available, one JSON
+    document per line. Every progress telegrams a status line is written
+    to stderr. With scaled set, records
+    carry their unit and the value with the VIF exponent applied. With
+    frame_format ('A' or 'B') the frames are expected to contain CRC blocks,
+    which are checked and stripped; frames failing the check are reported as
+    errors without being decoded.
+
+    Returns the tuple (number of telegrams, number of failures).
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    decode = partial(decode_telegram, scaled=scaled, frame_format=frame_format)
+    out = output if output is not None else sys.stdout
+    count = 0
+    failed = 0
+    started = time.monotonic()
+
+    with open(path, 'rb' if fmt == FORMAT_RAW else 'r') as f:
+        if fmt == FORMAT_HEX:
+            telegrams = read_hex(f)
+        elif fmt == FORMAT_NDJSON:
+            telegrams = read_ndjson(f)
+        elif fmt == FORMAT_RAW:
+            telegrams = read_raw(f, frame_format=frame_format)
+        else:
+            raise ValueError("decode_file(): unknown input format %s" % fmt)
+
+        with redirect_stdout(sys.stderr):
+            if jobs > 1:
+                pool = Pool(jobs, initializer=_init_worker)
+                results = imap_bounded(pool, decode, telegrams, chunk_size, 2 * jobs)
+            else:
+                pool = None
+                debug = wmbus.debug
+                wmbus.debug = 0
+                results = map(decode, telegrams)
+
+            try:
+                for result in results:
+                    if 'error' in result:
+                        failed += 1
+                    out.write(json.dumps(result, default=json_default))
+                    out.write('\n')
+                    count += 1
+
+                    if progress and count % progress == 0:
+                        rate = count / max(time.monotonic() - started, 1e-9)
+                        print("%d telegrams, %d failed, %.0f telegrams/s" % (count, failed, rate), file=sys.stderr)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+                else:
+                    wmbus.debug = debug
+
+    out.flush()
+    return count, failed
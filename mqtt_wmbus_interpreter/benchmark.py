@@ -0,0 +1,222 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+import time
+import random
+import tracemalloc
+
+from . import wmbus
+from .batch import read_hex, read_ndjson, json_default
+from .wmbus_interpreter import interpret, Interpreter
+from .result_codec import ResultEncoder, ResultDecoder
+
+def load_results(path, fmt='hex', descriptors=False):
+    """ Interprets all telegrams of a capture file and returns the results
+
+    Telegrams which cannot be interpreted are skipped.
+    """
+    debug = wmbus.debug
+    wmbus.debug = 0
+    results = []
+    try:
+        with open(path) as f:
+            for telegram in (read_ndjson(f) if fmt == 'ndjson' else read_hex(f)):
+                try:
+                    results.append(interpret(telegram, descriptors=descriptors))
+                except Exception:
+                    pass
+    finally:
+        wmbus.debug = debug
+    return results
+
+def bench_encoding(results, rounds=5):
+    """ Compares size and speed of the binary result encoding with JSON
+
+    Returns a dictionary with the total encoded size in bytes and the best
+    encode/decode time per frame in microseconds for both encodings.
+    """
+    report = {"frames": len(results)}
+    frames = max(len(results), 1)
+
+    best = None
+    for i in range(rounds):
+        started = time.perf_counter()
+        encoded = [json.dumps(result, default=json_default) for result in results]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    report["json_bytes"] = sum(len(line.encode('utf-8')) + 1 for line in encoded)
+    report["json_encode_us"] = best * 1e6 / frames
+
+    best = None
+    for i in range(rounds):
+        started = time.perf_counter()
+        for line in encoded:
+            json.loads(line)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    report["json_decode_us"] = best * 1e6 / frames
+
+    best = None
+    for i in range(rounds):
+        encoder = ResultEncoder()
+        started = time.perf_counter()
+        stream = b''.join([encoder.encode(result, 0.0) for result in results])
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    report["binary_bytes"] = len(stream)
+    report["binary_encode_us"] = best * 1e6 / frames
+
+    best = None
+    for i in range(rounds):
+        decoder = ResultDecoder()
+        started = time.perf_counter()
+        decoder.feed(stream)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    report["binary_decode_us"] = best * 1e6 / frames
+
+    return report
+
+def _module(filename):
+    # module name of a source file, package modules with their package
+    parts = os.path.splitext(filename)[0].split(os.sep)
+    if 'mqtt_wmbus_interpreter' in parts:
+        return '.'.join(parts[parts.index('mqtt_wmbus_interpreter'):])
+    return parts[-1]
+
+def _by_module(before, after):
+    # allocation growth between two snapshots, grouped by module
+    modules = {}
+    for stat in after.compare_to(before, 'filename'):
+        name = _module(stat.traceback[0].filename)
+        modules[name] = modules.get(name, 0) + stat.size_diff
+    return dict(sorted(modules.items(), key=lambda item: -item[1]))
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+def bench_memory(devices=100000, frames=1, seed=0):
+    """ Measures the memory held per device by the interpreter state
+
+    Synthetic devices (see simulator.SimMeter) are fed through an
+    Interpreter in phases: their AES keys are added, frames are parsed and
+    the WMBusFrame objects are retained (as for diagnostics), and the
+    latest result dictionary of every device is kept. The format cache and
+    descriptor registry grow along with the frames.
+
+    Every phase is measured with tracemalloc snapshots. The report holds
+    the bytes allocated per phase, grouped by module, the bytes per device
+    and per retained frame.
+    """
+    from .simulator import METER_MIX, MANUFACTURERS, DEVICE_TYPES, build_frame, meter_records, manufacturer_bytes
+
+    rng = random.Random(seed)
+    kinds = [kind for kind, share in METER_MIX]
+    weights = [share for kind, share in METER_MIX]
+    meters = [rng.choices(kinds, weights)[0] for i in range(devices)]
+
+    def telegram(i, reading):
+        kind = meters[i]
+        manufacturer = manufacturer_bytes(MANUFACTURERS[kind][i % len(MANUFACTURERS[kind])])
+        frame = build_frame(0x10000000 + i, manufacturer, DEVICE_TYPES[kind], reading & 0xFF,
+                            meter_records(kind, reading, rng))
+        return {"data": frame.hex()}
+
+    report = {"devices": devices, "frames": devices * frames, "phases": {}}
+    interpreter = Interpreter(debug=0)
+    retained = []
+    latest = {}
+
+    tracemalloc.start()
+    try:
+        before = _snapshot()
+        started = tracemalloc.get_traced_memory()[0]
+
+        def phase(name, before, count):
+            after = _snapshot()
+            modules = _by_module(before, after)
+            size = sum(modules.values())
+            report["phases"][name] = {
+                "bytes": size,
+                "per_device": size / max(devices, 1),
+                "per_item": size / max(count, 1),
+                "modules": modules
+            }
+            return after
+
+        for i in range(devices):
+            interpreter.add_key('%08x' % (0x10000000 + i), bytes(rng.getrandbits(8) for b in range(16)).hex())
+        before = phase("keys", before, devices)
+
+        for reading in range(frames):
+            for i in range(devices):
+                retained.append(interpreter.parse(telegram(i, reading)))
+        before = phase("frames", before, devices * frames)
+
+        for i in range(devices):
+            result = interpreter.interpret(telegram(i, frames))
+            latest[result["serial"]] = result
+        before = phase("results", before, devices)
+
+        total = tracemalloc.get_traced_memory()[0] - started
+    finally:
+        tracemalloc.stop()
+
+    report["total_bytes"] = total
+    report["bytes_per_device"] = total / max(devices, 1)
+    report["bytes_per_frame"] = report["phases"]["frames"]["per_item"]
+    return report
+
+def print_memory_report(report, top=5):
+    print("memory per device (%d devices, %d retained frames)" % (report["devices"], report["frames"]))
+    for name, phase in report["phases"].items():
+        print("  %-20s %12d bytes %10.1f per device %10.1f per item" % (
+            name, phase["bytes"], phase["per_device"], phase["per_item"]))
+        for module, size in list(phase["modules"].items())[0:top]:
+            print("    %-44s %12d" % (module, size))
+    print("  %-20s %12d bytes %10.1f per device" % ("total", report["total_bytes"], report["bytes_per_device"]))
+    print("  %-20s %12.1f" % ("bytes per frame", report["bytes_per_frame"]))
+
+def check_memory(report, max_per_device=None, max_per_frame=None):
+    """ Returns the list of exceeded memory thresholds
+    """
+    failures = []
+    if max_per_device is not None and report["bytes_per_device"] > max_per_device:
+        failures.append("%.1f bytes per device exceed the limit of %.1f" % (report["bytes_per_device"], max_per_device))
+    if max_per_frame is not None and report["bytes_per_frame"] > max_per_frame:
+        failures.append("%.1f bytes per frame exceed the limit of %.1f" % (report["bytes_per_frame"], max_per_frame))
+    return failures
+
+def print_report(title, report):
+    print(title)
+    for key, value in report.items():
+        if isinstance(value, float):
+            print("  %-20s %12.2f" % (key, value))
+        else:
+            print("  %-20s %12s" % (key, value))
@@ -0,0 +1,199 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+import time
+import threading
+
+# seconds a circuit stays open after its first, second, ... trip
+DEFAULT_BACKOFF = (60, 300, 900, 3600)
+
+class DeviceCircuitBreaker():
+
+    def __init__(self, threshold=5, backoff=DEFAULT_BACKOFF, max_devices=100000):
+        """ Tracks decode failures per device and stops decoding broken meters
+
+        After threshold consecutive failures the circuit of a device opens
+        and allow() rejects its telegrams until the backoff of the trip has
+        passed. The next telegram is then let through as the only probe:
+        success closes the circuit, another failure opens it again with the
+        next, longer backoff. Until the probe reports back (or the shortest
+        backoff passed) further telegrams are rejected. Devices are
+        identified by the key returned from wmbus.peek_device_key(), so a
+        telegram is rejected without decoding anything but its link layer
+        header. Failures of telegrams without a readable header (empty key)
+        are not tracked, they do not belong to one device.
+
+        At most max_devices failing devices are tracked, the oldest entries
+        are dropped beyond that.
+        """
+        self.threshold = threshold
+        self.backoff = tuple(backoff)
+        self.max_devices = max_devices
+        # device key -> [consecutive failures, open until, trips]
+        self.devices = {}
+        self.rejected = 0
+
+    def allow(self, device, now=None):
+        """ Returns False if the circuit of the device is open
+        """
+        state = self.devices.get(device)
+        if state is None or state[1] == 0:
+            return True
+        now = time.monotonic() if now is None else now
+        if now >= state[1]:
+            # half open, let a single probe through
+            state[1] = now + self.backoff[0]
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self, device):
+        """ Closes the circuit of a device after a successful decode
+        """
+        if self.devices:
+            self.devices.pop(device, None)
+
+    def failure(self, device, now=None):
+        """ Counts a failure, returns True if the circuit (re)opened
+        """
+        if not device:
+            return False
+        state = self.devices.get(device)
+        if state is None:
+            if len(self.devices) >= self.max_devices:
+                del self.devices[next(iter(self.devices))]
+            state = self.devices[device] = [0, 0, 0]
+
+        state[0] += 1
+        if state[0] < self.threshold:
+            return False
+
+        now = time.monotonic() if now is None else now
+        state[1] = now + self.backoff[min(state[2], len(self.backoff) - 1)]
+        state[2] += 1
+        return True
+
+    def is_open(self, device, now=None):
+        """ Returns True if telegrams of the device are currently rejected
+        """
+        state = self.devices.get(device)
+        return state is not None and (time.monotonic() if now is None else now) < state[1]
+
+    def open_devices(self, now=None):
+        """ Returns the keys of all devices with an open circuit
+        """
+        now = time.monotonic() if now is None else now
+        return [device for device, state in self.devices.items() if now < state[1]]
+
+    def get_state(self):
+        """ Returns the device states for a snapshot
+
+        The end of an open circuit is converted to wall clock time, as the
+        monotonic clock does not survive a restart.
+        """
+        now = time.monotonic()
+        wall = time.time()
+        return [(device, failures, wall + open_until - now if open_until else 0, trips)
+                for device, (failures, open_until, trips) in list(self.devices.items())]
+
+    def set_state(self, state):
+        """ Restores the device states of a snapshot
+        """
+        now = time.monotonic()
+        wall = time.time()
+        for device, failures, open_until, trips in state:
+            if device not in self.devices and len(self.devices) < self.max_devices:
+                self.devices[device] = [failures, now + open_until - wall if open_until else 0, trips]
+
+    def stats(self):
+        """ Returns the number of tracked, open and rejected devices resp. telegrams
+        """
+        return {
+            "tracked": len(self.devices),
+            "open": len(self.open_devices()),
+            "rejected": self.rejected
+        }
+
+class DeadLetterStore():
+
+    def __init__(self, path, max_bytes=10*1024*1024, every=10):
+        """ Keeps samples of undecodable telegrams in an NDJSON file
+
+        The first failure of a device and every further every-th one is
+        written as a line holding time, device, failure category, error
+        message and the raw telegram. Once the file exceeds max_bytes it is
+        moved to path + '.1' (replacing the previous one), so the store never
+        takes more than about twice max_bytes on disk.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.every = every
+        self.counts = {}
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def add(self, device, category, telegram, error):
+        """ Records a failure, returns True if the telegram was written
+        """
+        with self.lock:
+            if len(self.counts) >= 100000:
+                self.counts.clear()
+            count = self.counts.get(device, 0)
+            self.counts[device] = count + 1
+            if count % self.every:
+                return False
+
+            data = telegram.get('data')
+            if not isinstance(data, str):
+                data = bytes(data).hex()
+            line = json.dumps({
+                "time": time.time(),
+                "device": device.hex(),
+                "category": category,
+                "error": str(error),
+                "telegram": data
+            }) + '\n'
+
+            try:
+                if os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+            except OSError:
+                pass
+            with open(self.path, 'a') as f:
+                f.write(line)
+            self.written += 1
+            return True
+
+    def read(self):
+        """ Yields the stored entries, oldest first
+        """
+        for path in (self.path + '.1', self.path):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        yield json.loads(line)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,301 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import struct
+import threading
+from array import array
+
+'''
+Segment file layout (all numbers little endian)
+
+header     magic b'WMBCOL01', number of rows (uint64)
+columns    time (int64, microseconds since the epoch), value (float64),
+           device (int32), descriptor (int32), n values each
+footer     JSON object with the column offsets, the min/max of every
+           column and the dictionaries mapping the segment local device
+           and descriptor ids to their manufacturer/serial resp.
+           DIF/VIF key/type/sensor/unit
+trailer    length of the footer (uint32), magic b'WMBCOL01'
+
+Readers only read the trailer and footer to decide whether a segment can
+hold matching rows and map the columns of the remaining ones.
+'''
+
+MAGIC = b'WMBCOL01'
+_HEADER = struct.Struct('<8sQ')
+_TRAILER = struct.Struct('<I8s')
+
+# column name, array type code, numpy dtype
+COLUMNS = (
+    ('time', 'q', '<i8'),
+    ('value', 'd', '<f8'),
+    ('device', 'i', '<i4'),
+    ('descriptor', 'i', '<i4')
+)
+
+class ColumnarWriter():
+
+    def __init__(self, directory, rows_per_segment=1000000, prefix='readings', max_age=300):
+        """ Writes the numeric readings of interpret() results into columnar segments
+
+        Every record becomes a row of time, device, descriptor and value.
+        Values are stored scaled (see WMBusRecordDescriptor.scale()) as
+        float64, records without numeric value (dates, text) are skipped.
+        Devices and descriptors are dictionary encoded per segment, the
+        descriptors by their DIF/VIF bytes (records of dictionary results,
+        which lack these, by type and sensor). Rollup buckets are not
+        stored, they have no single value.
+
+        A segment is written once it holds rows_per_segment rows, once its
+        oldest row is max_age seconds old (checked by a background thread,
+        so a slow receiver does not keep readings in memory for hours) and
+        on close(). It is written to a temporary file and renamed, so
+        readers never see partial segments.
+
+        The writer only needs the array module, see ColumnarArchive for
+        the numpy based reader.
+        """
+        self.directory = directory
+        self.rows_per_segment = rows_per_segment
+        self.prefix = prefix
+        self.max_age = max_age
+        self.segments = 0
+        self.skipped = 0
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.reset()
+
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.flush_aged, name="columnar-writer", daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        self.columns = {name: array(code) for name, code, dtype in COLUMNS}
+        self.devices = {}
+        self.descriptors = {}
+        self.descriptor_info = []
+        self.started = None
+
+    def flush_aged(self):
+        # writes the pending rows once the oldest one is max_age seconds old
+        while not self.closed.wait(min(self.max_age, 1.0)):
+            with self.lock:
+                if self.started is not None and time.monotonic() - self.started >= self.max_age:
+                    self.flush()
+
+    def write(self, result, timestamp=None):
+        """ Appends the records of an interpret() result (sink interface)
+        """
+        if result is None or "data" not in result:
+            return
+        with self.lock:
+            self.append(result, timestamp)
+            if self.started is None and len(self.columns['time']):
+                self.started = time.monotonic()
+
+    def append(self, result, timestamp):
+        micros = int((time.time() if timestamp is None else timestamp) * 1e6)
+        key = (result["manufacturer"], result["serial"])
+        device = self.devices.get(key)
+        if device is None:
+            device = self.devices[key] = len(self.devices)
+
+        columns = self.columns
+        descriptors = self.descriptors
+        for record in result["data"]:
+            if isinstance(record, tuple):
+                d, value = record
+                sensor_key = (d.key.hex(), d.type, d.sensor)
+                value = d.scale(value)
+                unit = d.unit
+            else:
+                sensor_key = (None, record["type"], record["sensor"])
+                value = record.get("scaled", record["value"])
+                unit = record.get("unit")
+            if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.skipped += 1
+                continue
+
+            descriptor = descriptors.get(sensor_key)
+            if descriptor is None:
+                descriptor = descriptors[sensor_key] = len(descriptors)
+                self.descriptor_info.append({"key": sensor_key[0], "type": sensor_key[1],
+                                             "sensor": sensor_key[2], "unit": unit})
+
+            columns['time'].append(micros)
+            columns['value'].append(value)
+            columns['device'].append(device)
+            columns['descriptor'].append(descriptor)
+
+        if len(columns['time']) >= self.rows_per_segment:
+            self.flush()
+
+    def flush(self):
+        """ Writes the pending rows as a segment, returns its path or None
+        """
+        with self.lock:
+            return self.write_segment()
+
+    def write_segment(self):
+        rows = len(self.columns['time'])
+        if not rows:
+            return None
+
+        path = os.path.join(self.directory, "%s-%s-%06d.col" % (
+            self.prefix, time.strftime('%Y%m%d-%H%M%S'), self.segments))
+        footer = {"rows": rows, "columns": {}, "devices": [], "descriptors": self.descriptor_info}
+        for (manufacturer, serial) in self.devices:
+            footer["devices"].append([manufacturer, serial])
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, rows))
+            for name, code, dtype in COLUMNS:
+                column = self.columns[name]
+                footer["columns"][name] = {"offset": f.tell(), "dtype": dtype,
+                                           "min": min(column), "max": max(column)}
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                column.tofile(f)
+            data = json.dumps(footer).encode('utf-8')
+            f.write(data)
+            f.write(_TRAILER.pack(len(data), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        self.segments += 1
+        self.reset()
+        return path
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+def read_footer(path):
+    """ Returns the footer of a segment without reading its columns
+    """
+    with open(path, 'rb') as f:
+        f.seek(-_TRAILER.size, os.SEEK_END)
+        length, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a columnar segment" % path)
+        f.seek(-_TRAILER.size - length, os.SEEK_END)
+        return json.loads(f.read(length).decode('utf-8'))
+
+class ColumnarArchive():
+
+    def __init__(self, directory, prefix='readings'):
+        """ Queries the segments written by a ColumnarWriter
+
+        Requires numpy. Segments are memory mapped, only the columns needed
+        by a query are paged in and filtered with vectorised comparisons.
+        Footers are cached, segments whose min/max or dictionaries exclude a
+        query are skipped without touching their columns.
+        """
+        import numpy
+        self.numpy = numpy
+        self.directory = directory
+        self.prefix = prefix
+        self.footers = {}
+
+    def segments(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, self.prefix + '-*.col')))
+        for path in paths:
+            if path not in self.footers:
+                self.footers[path] = read_footer(path)
+        return [(path, self.footers[path]) for path in paths]
+
+    def column(self, path, footer, name):
+        info = footer["columns"][name]
+        return self.numpy.memmap(path, dtype=info["dtype"], mode='r', offset=info["offset"],
+                                 shape=(footer["rows"],))
+
+    def query(self, descriptor, devices=None, start=None, end=None):
+        """ Returns the readings of a descriptor for devices within [start, end)
+
+        descriptor is a sensor name (e.g. 'Volume l'), a (type, sensor)
+        tuple or the hex DIF/VIF bytes (e.g. '0c13'), devices an iterable
+        of serials or (manufacturer, serial) tuples (None: all devices),
+        start and end are epoch seconds.
+
+        Returns a dict of numpy arrays: time (epoch microseconds), value
+        and serial.
+        """
+        np = self.numpy
+        wanted = None
+        if devices is not None:
+            wanted = set(tuple(device) if isinstance(device, (tuple, list)) else device
+                         for device in devices)
+        start_us = None if start is None else int(start * 1e6)
+        end_us = None if end is None else int(end * 1e6)
+
+        times, values, serials = [], [], []
+        for path, footer in self.segments():
+            column = footer["columns"]["time"]
+            if start_us is not None and column["max"] < start_us:
+                continue
+            if end_us is not None and column["min"] >= end_us:
+                continue
+
+            ids = [i for i, info in enumerate(footer["descriptors"])
+                   if descriptor in (info["sensor"], info.get("key"))
+                   or [info["type"], info["sensor"]] == list(descriptor)]
+            if not ids:
+                continue
+
+            device_ids = None
+            if wanted is not None:
+                device_ids = [i for i, (manufacturer, serial) in enumerate(footer["devices"])
+                              if serial in wanted or (manufacturer, serial) in wanted]
+                if not device_ids:
+                    continue
+
+            descriptor_column = self.column(path, footer, "descriptor")
+            mask = np.isin(descriptor_column, ids) if len(ids) > 1 else descriptor_column == ids[0]
+            time_column = self.column(path, footer, "time")
+            if start_us is not None:
+                mask &= time_column >= start_us
+            if end_us is not None:
+                mask &= time_column < end_us
+            device_column = self.column(path, footer, "device")
+            if device_ids is not None:
+                mask &= np.isin(device_column, device_ids)
+
+            rows = np.flatnonzero(mask)
+            times.append(np.asarray(time_column[rows]))
+            values.append(np.asarray(self.column(path, footer, "value")[rows]))
+            names = np.array([serial for manufacturer, serial in footer["devices"]], dtype=object)
+            serials.append(names[np.asarray(device_column[rows])])
+
+        if not times:
+            return {"time": np.empty(0, '<i8'), "value": np.empty(0, '<f8'),
+                    "serial": np.empty(0, object)}
+        return {"time": np.concatenate(times), "value": np.concatenate(values),
+                "serial": np.concatenate(serials)}
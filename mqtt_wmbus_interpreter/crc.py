@@ -0,0 +1,170 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from .errors import CRCError
+
+# CRC polynomial as specified in EN 13757-4 (x^16+x^13+x^12+x^11+x^10+x^8+x^6+x^5+x^2+1)
+CRC_POLYNOMIAL = 0x3D65
+
+def _build_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ CRC_POLYNOMIAL) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = _build_table()
+
+def crc16(data):
+    """ Returns the EN 13757-4 CRC of data (bytes, bytearray or memoryview)
+
+    The CRC starts with 0x0000 and the result is complemented.
+    """
+    table = CRC_TABLE
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+    return crc ^ 0xFFFF
+
+FRAME_FORMAT_A = 'A'
+FRAME_FORMAT_B = 'B'
+
+# size of the first block (L, C, M and A field) in both frame formats
+FIRST_BLOCK = 10
+# frame format A data blocks following the first block
+BLOCK_A = 16
+# frame format B: the second block ends after 128 bytes of the frame
+BLOCK_B_END = 128
+
+def crc_ok(view, start, end):
+    """ Returns True if the CRC following view[start:end] matches
+
+    The CRC is transmitted high byte first in the two bytes after end.
+    """
+    if end + 2 > len(view):
+        return False
+    return crc16(view[start:end]) == (view[end] << 8 | view[end+1])
+
+def frame_length(lfield, fmt):
+    """ Returns the number of bytes of a frame including all CRC bytes
+
+    In frame format A the L-field excludes the CRC bytes, thus the number of
+    blocks has to be derived from it. In format B the L-field already counts
+    the CRC bytes.
+    """
+    if fmt == FRAME_FORMAT_B:
+        return lfield + 1
+
+    blocks = 1 + (lfield - (FIRST_BLOCK - 1) + BLOCK_A - 1) // BLOCK_A
+    return lfield + 1 + 2 * blocks
+
+def strip_crc(frame, fmt=FRAME_FORMAT_A, out=None):
+    """ Validates and strips the CRC blocks of a frame in one pass
+
+    The data blocks are copied into out (a bytearray which is cleared and
+    reused if given) and out is returned. The L-field of the result counts
+    the data bytes only, just like in CRC-free frames. A CRCError is raised
+    if any block fails its CRC check or the frame is truncated.
+    """
+    view = memoryview(frame)
+    if out is None:
+        out = bytearray()
+    else:
+        del out[:]
+
+    try:
+        if len(view) < FIRST_BLOCK + 2:
+            raise CRCError("Frame too short")
+
+        if fmt == FRAME_FORMAT_A:
+            end = frame_length(view[0], fmt)
+            if len(view) < end:
+                raise CRCError("Frame shorter than announced by its L-field")
+            if not crc_ok(view, 0, FIRST_BLOCK):
+                raise CRCError("CRC error in block 1")
+            out += view[0:FIRST_BLOCK]
+
+            pos = FIRST_BLOCK + 2
+            block = 2
+            while pos < end:
+                stop = min(pos + BLOCK_A, end - 2)
+                if not crc_ok(view, pos, stop):
+                    raise CRCError("CRC error in block %d" % block)
+                out += view[pos:stop]
+                pos = stop + 2
+                block += 1
+
+        elif fmt == FRAME_FORMAT_B:
+            end = frame_length(view[0], fmt)
+            if len(view) < end:
+                raise CRCError("Frame shorter than announced by its L-field")
+
+            # block 1 and 2 share one CRC, block 3 holds the remainder
+            stop = min(BLOCK_B_END, end) - 2
+            if not crc_ok(view, 0, stop):
+                raise CRCError("CRC error in block 2")
+            out += view[0:stop]
+
+            if end > BLOCK_B_END:
+                if not crc_ok(view, BLOCK_B_END, end - 2):
+                    raise CRCError("CRC error in block 3")
+                out += view[BLOCK_B_END:end-2]
+
+        else:
+            raise ValueError("strip_crc(): unknown frame format %s" % fmt)
+
+    finally:
+        view.release()
+
+    out[0] = len(out) - 1
+    return out
+
+def verify_frames(frames, fmt=FRAME_FORMAT_A):
+    """ Checks the CRCs of many frames, returns a list of booleans
+
+    A single output buffer is reused for all frames.
+    """
+    out = bytearray()
+    results = []
+    for frame in frames:
+        try:
+            strip_crc(frame, fmt, out)
+            results.append(True)
+        except CRCError:
+            results.append(False)
+    return results
+
+def strip_frames(frames, fmt=FRAME_FORMAT_A):
+    """ Yields the CRC-free copy of every frame, None for invalid frames
+    """
+    for frame in frames:
+        try:
+            yield bytes(strip_crc(frame, fmt))
+        except CRCError:
+            yield None
@@ -0,0 +1,129 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import threading
+from collections import namedtuple
+
+from .wmbus import WMBusFrame
+
+class DeviceIdentity(namedtuple('DeviceIdentity',
+        'id key manufacturer serial version device_type device_id metadata')):
+    """ Interned link layer identity of a device
+
+    key holds the manufacturer and address bytes (see
+    WMBusFrame.get_device_key()), device_id the id as used by the key store
+    (latin-1 string, see WMBusFrame.parse()) and metadata a dictionary of
+    configured values, e.g. a location. id is a small integer which is
+    unique within the process and can be used to index per device arrays,
+    it is None for identities which are not registered (see
+    DeviceRegistry.identify()).
+    """
+    __slots__ = ()
+
+class DeviceRegistry():
+
+    def __init__(self, max_devices=1000000):
+        """ Identities of all devices seen, by their manufacturer and address
+
+        The first sighting of a device decodes its identity from the 8 link
+        layer bytes, later lookups are a single dictionary access. All frames
+        of a device share the same DeviceIdentity object and strings.
+
+        At most max_devices devices are registered, lookup() returns
+        unregistered identities beyond that (counted in overflow). As
+        identities are never dropped, frames should only be registered once
+        they were parsed successfully, see identify().
+        """
+        self.max_devices = max_devices
+        self.overflow = 0
+        self.devices = {}
+        self.by_id = []
+        # metadata configured for devices which were not seen yet, by serial
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """ Returns the identity for the manufacturer and address bytes
+        """
+        identity = self.devices.get(key)
+        if identity is None:
+            with self.lock:
+                identity = self.devices.get(key)
+                if identity is None:
+                    if len(self.by_id) >= self.max_devices:
+                        self.overflow += 1
+                        return self.create(bytes(key), None)
+                    identity = self.create(bytes(key), len(self.by_id))
+                    self.by_id.append(identity)
+                    self.devices[identity.key] = identity
+        return identity
+
+    def get(self, key):
+        """ Returns the registered identity of a device, or None
+        """
+        return self.devices.get(key)
+
+    def identify(self, key):
+        """ Returns the identity of a device without registering it
+
+        Devices which were not registered yet get an identity with id None.
+        """
+        identity = self.devices.get(key)
+        if identity is None:
+            identity = self.create(bytes(key), None)
+        return identity
+
+    def create(self, key, id):
+        # decode the identity with the WMBusFrame methods
+        frame = WMBusFrame()
+        frame.manufacturer = bytearray(key[0:2])
+        frame.address = bytearray(key[2:8])
+        serial = frame.getSerial()
+        return DeviceIdentity(
+            id,
+            key,
+            frame.get_manufacturer_short()[0:3].decode('UTF-8'),
+            serial,
+            frame.get_device_version(),
+            frame.get_device_type().strip(),
+            ''.join(chr(b) for b in frame.get_device_id()),
+            dict(self.pending.get(serial, ())))
+
+    def by_serial(self, serial):
+        """ Returns the identities of all devices with the given serial
+        """
+        return [identity for identity in list(self.by_id) if identity.serial == serial]
+
+    def configure(self, serial, **metadata):
+        """ Sets metadata of the devices with the given serial
+
+        The metadata also applies to devices seen later on.
+        """
+        with self.lock:
+            self.pending.setdefault(serial, {}).update(metadata)
+        for identity in self.by_serial(serial):
+            identity.metadata.update(metadata)
+
+    def __len__(self):
+        return len(self.by_id)
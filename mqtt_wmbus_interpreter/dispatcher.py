@@ -0,0 +1,220 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import zlib
+import threading
+from queue import Queue, Empty
+
+from .wmbus import peek_device_key
+from .wmbus_interpreter import interpret
+from .tracing import finish
+
+# marker which tells a shard worker to terminate
+_STOP = object()
+
+def shard_key(telegram):
+    """ Returns the manufacturer and address bytes used to route a telegram
+
+    'data' is either the hex string sent by the gateway or the frame bytes
+    (e.g. a memoryview into a SharedRingBuffer). Only the link layer header
+    is converted, so routing does not depend on the size of the frame.
+    """
+    try:
+        data = telegram['data']
+        if isinstance(data, str):
+            return peek_device_key(bytes.fromhex(data[0:20]))
+        return peek_device_key(data[0:10])
+    except (KeyError, TypeError, ValueError):
+        return b''
+
+def jump_hash(key, buckets):
+    """ Returns the bucket (0 .. buckets-1) of an integer key
+
+    Jump consistent hash (Lamping, Veach): if the number of buckets grows
+    from n to n+1, only about 1/(n+1) of the keys move, all of them to the
+    new bucket.
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+class _Shard():
+
+    def __init__(self, index, handler, output):
+        # holds one worker thread and its FIFO of pending telegrams
+        self.index = index
+        self.handler = handler
+        self.output = output
+        self.queue = Queue()
+        self.processed = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, name="wmbus-shard-%d" % index, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # a handler bound to a throttling Interpreter also hands out the
+        # held telegrams it released, checked after every telegram and idle
+        interpreter = getattr(self.handler, '__self__', None)
+        release = None
+        if getattr(interpreter, 'throttle', None) is not None:
+            release = interpreter.release_throttled
+        while True:
+            try:
+                telegram = self.queue.get(timeout=None if release is None else 1.0)
+            except Empty:
+                self.release(release)
+                continue
+            try:
+                if telegram is _STOP:
+                    if release is not None:
+                        self.release(release)
+                    return
+                result = self.handler(telegram)
+                self.processed += 1
+                if release is not None:
+                    self.release(release)
+                if self.output is not None:
+                    self.output.put(result)
+            except Exception as e:
+                self.failed += 1
+                print(e)
+            finally:
+                if telegram is not _STOP:
+                    finish(telegram)
+                self.queue.task_done()
+
+    def release(self, release):
+        try:
+            results = release()
+        except Exception as e:
+            print(e)
+            return
+        if self.output is not None:
+            for result in results:
+                self.output.put(result)
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+class ShardedDispatcher():
+
+    def __init__(self, workers, handler_factory=None, output=None):
+        """ Distributes telegrams to a fixed set of device affine workers
+
+        Every telegram is routed by a consistent hash of the device
+        manufacturer and address to exactly one shard. Each shard is served
+        by a single worker thread, thus all telegrams of a meter are
+        interpreted in the order they arrived. The
+        handler_factory is called with the shard index and returns the
+        callable which interprets a telegram on that shard. Per device state
+        (keys, decode plans, last values) held by a handler is therefore only
+        ever touched by one worker, e.g. with
+        handler_factory=lambda index: Interpreter(keys).interpret every shard
+        owns its interpreter state. The handler results are put into the
+        optional output queue, for an Interpreter with a DeviceThrottle
+        along with the results of its released telegrams.
+
+        The dispatcher provides a put() method and can be passed to
+        startReceiver() in place of a plain queue.
+        """
+        if handler_factory is None:
+            handler_factory = lambda index: interpret
+
+        self.handler_factory = handler_factory
+        self.output = output
+        self.shards = []
+        self.lock = threading.Lock()
+        self.resize(workers)
+
+    def shard_for(self, telegram):
+        """ Returns the shard index responsible for the sending device
+        """
+        return jump_hash(zlib.crc32(shard_key(telegram)), len(self.shards))
+
+    def put(self, telegram):
+        """ Queues a telegram on the shard of its sending device
+        """
+        with self.lock:
+            self.shards[self.shard_for(telegram)].queue.put(telegram)
+
+    def resize(self, workers):
+        """ Changes the number of workers and rebalances the shards
+
+        Routing is suspended while all shards drain their pending telegrams.
+        Afterwards the devices are distributed over the new set of shards.
+        Handlers of shards which exist before and after the change are kept,
+        and as routing is consistent, only the devices of removed shards
+        resp. about 1/n of the devices (moving to the added shards) change
+        their shard and lose the state their former handler kept.
+        """
+        if workers < 1:
+            raise ValueError("resize(): at least one worker is required")
+
+        with self.lock:
+            for shard in self.shards:
+                shard.queue.join()
+
+            handlers = [shard.handler for shard in self.shards]
+            for shard in self.shards[workers:]:
+                shard.stop()
+
+            shards = self.shards[0:workers]
+            for index in range(len(shards), workers):
+                handler = handlers[index] if index < len(handlers) else self.handler_factory(index)
+                shards.append(_Shard(index, handler, self.output))
+
+            self.shards = shards
+
+    def join(self):
+        """ Blocks until every queued telegram has been interpreted
+        """
+        for shard in list(self.shards):
+            shard.queue.join()
+
+    def stop(self):
+        """ Drains and terminates all workers
+        """
+        with self.lock:
+            for shard in self.shards:
+                shard.stop()
+            self.shards = []
+
+    def queue_depths(self):
+        """ Returns the number of pending telegrams per shard
+        """
+        return [shard.queue.qsize() for shard in self.shards]
+
+    def stats(self):
+        """ Returns queue depth and counters for every shard
+        """
+        return [{
+            "shard": shard.index,
+            "depth": shard.queue.qsize(),
+            "processed": shard.processed,
+            "failed": shard.failed
+        } for shard in self.shards]
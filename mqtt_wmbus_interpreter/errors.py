@@ -0,0 +1,78 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+class WMBusError(Exception):
+    """ Base class of all errors raised while decoding a frame
+
+    The category names the kind of failure in metrics and dead letters.
+    """
+    category = "frame"
+
+class FrameLengthError(WMBusError):
+    """ Raised if the L-field does not describe a valid frame
+    """
+    category = "length"
+
+class TruncatedFrameError(WMBusError):
+    """ Raised if a frame ends before the data announced by its content
+    """
+    category = "truncated"
+
+class CRCError(WMBusError):
+    """ Raised if a frame fails the CRC check or does not fit its L-field
+    """
+    category = "crc"
+
+class DecryptionError(WMBusError):
+    """ Raised if an encrypted frame does not decrypt with the device key
+    """
+    category = "decryption"
+
+class MissingKeyError(DecryptionError):
+    """ Raised if a frame is encrypted but no key is known for the device
+    """
+    category = "key"
+
+class UnknownFormatError(WMBusError):
+    """ Raised if the format signature of a compact frame was not learned yet
+    """
+    category = "format"
+
+class RecordError(WMBusError):
+    """ Raised if a data record header is not supported (e.g. DIF/VIF chains)
+    """
+    category = "record"
+
+def error_category(exc):
+    """ Returns the failure category of an exception raised by a decode
+
+    Index errors are raised by the record parser running past the end of a
+    frame and are categorised as truncated frames, everything else which is
+    not a WMBusError as "internal".
+    """
+    if isinstance(exc, WMBusError):
+        return exc.category
+    if isinstance(exc, IndexError):
+        return TruncatedFrameError.category
+    return "internal"
@@ -0,0 +1,228 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import csv
+import gzip
+import json
+import time
+import shutil
+import threading
+from queue import Queue
+
+from .batch import json_default
+
+# one encoder for all lines, json.dumps() with a default creates one per call
+_encoder = json.JSONEncoder(default=json_default, check_circular=False)
+
+CSV_COLUMNS = ('time', 'manufacturer', 'serial', 'type', 'sensor', 'value', 'unit', 'scaled')
+# columns of rollup buckets, see ConsumptionRollup.close()
+CSV_ROLLUP_COLUMNS = ('manufacturer', 'serial', 'type', 'sensor', 'key', 'unit', 'start', 'end', 'count',
+                      'first', 'last', 'min', 'max', 'delta', 'rate', 'resets')
+
+def _csv_value(value):
+    # dates, byte strings and variable length values as in NDJSON
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return json_default(value)
+
+class _Lines(list):
+    # file like target of csv.writer, collects the formatted lines
+    write = list.append
+
+class FileSink():
+
+    def __init__(self, path, fmt='ndjson', buffer_size=1 << 20, max_bytes=256 << 20, max_age=3600,
+                 fsync_interval=1.0, compress=True):
+        """ Writes interpret() results into rotating NDJSON or CSV files
+
+        path is the base name of the segments, e.g. /var/lib/wmbus/readings
+        is written to /var/lib/wmbus/readings-20240101-120000.ndjson. NDJSON
+        segments hold one result per line, CSV segments one row per record
+        (see CSV_COLUMNS) or per rollup bucket (see CSV_ROLLUP_COLUMNS). A
+        CSV segment holds either kind of rows only, a new segment is started
+        if the kind changes.
+
+        Output goes through a write buffer of buffer_size bytes, so there is
+        one write() system call per buffer instead of per result. A segment
+        is closed once it holds max_bytes or is max_age seconds old, closed
+        segments are gzip compressed by a background thread if compress is
+        set. A second thread flushes and fsyncs the current segment every
+        fsync_interval seconds, so at most that much output is lost on a
+        power failure.
+        """
+        if fmt not in ('ndjson', 'csv'):
+            raise ValueError("FileSink: unknown format %s" % fmt)
+
+        self.path = path
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.compress = compress
+        self.lines = _Lines()
+        self.csv = csv.writer(self.lines)
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = None
+        self.header = None
+        self.opened = 0
+        self.size = 0
+        self.dirty = False
+        self.metrics = {"results": 0, "bytes": 0, "segments": 0, "compressed": 0, "fsyncs": 0}
+
+        self.closed = threading.Event()
+        self.compressor = Queue()
+        self.threads = [
+            threading.Thread(target=self.compress_segments, name="file-sink-compress", daemon=True),
+            threading.Thread(target=self.sync, name="file-sink-sync", daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def open_segment(self):
+        now = time.time()
+        name = "%s-%s.%s" % (self.path, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), self.fmt)
+        suffix = 0
+        while os.path.exists(name) or os.path.exists(name + '.gz'):
+            suffix += 1
+            name = "%s-%s-%d.%s" % (self.path, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), suffix, self.fmt)
+        self.file = open(name, 'wb', buffering=self.buffer_size)
+        self.segment = name
+        self.opened = now
+        self.size = 0
+        self.header = None
+        self.metrics["segments"] += 1
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.dirty = False
+        if self.compress:
+            self.compressor.put(self.segment)
+
+    def append(self):
+        # writes the collected lines into the buffer of the segment
+        data = ''.join(self.lines).encode('utf-8')
+        self.lines.clear()
+        self.file.write(data)
+        self.size += len(data)
+        self.metrics["bytes"] += len(data)
+        self.dirty = True
+
+    def write(self, result, timestamp=None):
+        """ Serialises an interpret() result or rollup bucket
+        """
+        if result is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        data = result.get("data")
+
+        with self.lock:
+            if self.file is None or self.size >= self.max_bytes or timestamp - self.opened >= self.max_age:
+                self.close_segment()
+                self.open_segment()
+
+            if self.fmt == 'csv':
+                columns = CSV_COLUMNS if data is not None else CSV_ROLLUP_COLUMNS
+                if self.header is not columns:
+                    if self.header is not None:
+                        self.close_segment()
+                        self.open_segment()
+                    self.csv.writerow(columns)
+                    self.header = columns
+
+            if self.fmt == 'csv' and data is None:
+                self.csv.writerow([_csv_value(result.get(column)) for column in columns])
+            elif self.fmt == 'csv':
+                manufacturer = result["manufacturer"]
+                serial = result["serial"]
+                for record in data:
+                    if isinstance(record, tuple):
+                        descriptor, value = record
+                        row = (timestamp, manufacturer, serial, descriptor.type, descriptor.sensor,
+                               _csv_value(value), descriptor.unit, descriptor.scale(value))
+                    else:
+                        row = (timestamp, manufacturer, serial, record["type"], record["sensor"],
+                               _csv_value(record["value"]), record.get("unit"), record.get("scaled"))
+                    self.csv.writerow(row)
+            else:
+                if data is not None and not isinstance(data, list):
+                    result = dict(result, data=list(data))
+                entry = dict(result, time=timestamp)
+                self.lines.append(_encoder.encode(entry) + '\n')
+            self.append()
+            self.metrics["results"] += 1
+
+    def sync(self):
+        # grouped fsync and time based rotation of idle sinks
+        while not self.closed.wait(self.fsync_interval):
+            with self.lock:
+                if self.file is None:
+                    continue
+                if time.time() - self.opened >= self.max_age:
+                    self.close_segment()
+                elif self.dirty:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.dirty = False
+                    self.metrics["fsyncs"] += 1
+
+    def compress_segments(self):
+        while True:
+            segment = self.compressor.get()
+            try:
+                if segment is None:
+                    return
+                with open(segment, 'rb') as src, gzip.open(segment + '.gz.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                os.replace(segment + '.gz.tmp', segment + '.gz')
+                os.remove(segment)
+                self.metrics["compressed"] += 1
+            except OSError as e:
+                print("FileSink: compressing %s failed: %s" % (segment, e))
+            finally:
+                self.compressor.task_done()
+
+    def close(self):
+        """ Closes the current segment and waits for its compression
+        """
+        self.closed.set()
+        self.threads[1].join()
+        with self.lock:
+            self.close_segment()
+        self.compressor.put(None)
+        self.threads[0].join()
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats["segment"] = self.segment
+        stats["pending_compression"] = self.compressor.qsize()
+        return stats
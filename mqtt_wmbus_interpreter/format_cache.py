@@ -0,0 +1,106 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from .crc import crc16
+
+class WMBusFormatCache():
+
+    def __init__(self, max_layouts=100000):
+        """ Record layouts of full frames by device and format signature
+
+        Compact frames (CI 79h, 7Bh, 73h) only carry the format signature
+        and the record data. The layout, i.e. the sequence of DIF/VIF
+        headers, is learned from earlier full frames of the same device. At
+        most max_layouts layouts are kept; the oldest one is dropped first.
+        """
+        self.max_layouts = max_layouts
+        self.layouts = {}
+
+    def learn(self, device, records):
+        """ Stores the layout of the parsed records of a full frame
+
+        Returns the format signature of the layout.
+        """
+        return self.learn_layout(device, tuple(layout_entry(rec.header) for rec in records))
+
+    def learn_layout(self, device, layout):
+        """ Stores a layout as built by layout_entry() for every record
+
+        Returns the format signature of the layout.
+        """
+        signature = get_layout_signature(layout)
+        key = (device, signature)
+
+        if key not in self.layouts:
+            if len(self.layouts) >= self.max_layouts:
+                del self.layouts[next(iter(self.layouts))]
+            self.layouts[key] = layout
+
+        return signature
+
+    def get(self, device, signature):
+        """ Returns the layout for device and signature or None if unknown
+        """
+        return self.layouts.get((device, signature))
+
+    def get_state(self):
+        """ Returns the learned layouts for a snapshot
+        """
+        return list(dict(self.layouts).items())
+
+    def set_state(self, state):
+        """ Adds the layouts of a snapshot, layouts learned since are kept
+        """
+        for key, layout in state:
+            if key not in self.layouts and len(self.layouts) < self.max_layouts:
+                self.layouts[key] = layout
+
+    def __len__(self):
+        return len(self.layouts)
+
+def layout_entry(header):
+    """ Returns the layout entry of a parsed WMBusDataRecordHeader
+    """
+    return (bytes(header.dif), bytes(header.vif), header.vif_text, header.vif_text_length)
+
+def get_layout_signature(layout):
+    """ Returns the format signature of a layout
+    """
+    fmt = bytearray()
+    for dif, vif, vif_text, vif_text_length in layout:
+        fmt += dif
+        fmt += vif
+    return crc16(fmt)
+
+def get_format_signature(records):
+    """ Returns the format signature of a sequence of parsed records
+
+    The signature is the CRC over all DIF/DIFE/VIF/VIFE bytes of the records
+    in order of transmission.
+    """
+    fmt = bytearray()
+    for rec in records:
+        fmt += rec.header.dif
+        fmt += rec.header.vif
+    return crc16(fmt)
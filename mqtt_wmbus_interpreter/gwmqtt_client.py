@@ -23,51 +23,82 @@ SOFTWARE.
 """
 
 import zlib
+import time
 import logging
 from queue import Queue
 import json
-import paho.mqtt.client as mqtt
 
-wmbusQueue = None
-topic_prefix = None
+class GWMQTTReceiver():
 
-def on_connect(client, userdata, flags, rc):
-    print("Connected with result code", rc)
-    client.subscribe(topic_prefix+"/+/out")
+    def __init__(self, queue, topicPrefix='gwmqtt', tracer=None):
+        """ Receives wM-Bus telegrams from gwmqtt gateways
 
-def on_message(client, userdata, msg):
-#    print(msg.topic, msg.payload)
-    try:
-        if msg.topic.endswith("/zlib"):
-            payload = json.loads(zlib.decompress(msg.payload).decode('utf-8'))
-        else:
-            payload = json.loads(msg.payload.decode('utf-8'))
-#        print(f"Msg. in: {msg.topic}: {payload}")
-        if 'method' in payload:
-            if payload['method'] == 'wmbus':
-                for telegram in payload['params']['telegrams']:
-#                    print(f"WMBUS: {telegram}")
-                    if wmbusQueue != None:
-                        wmbusQueue.put(telegram)
-    except Exception as e:
-        print(e)
+        Telegrams of all gateways publishing below topicPrefix are put into
+        queue (any object providing put(), e.g. a ShardedDispatcher). Every
+        receiver holds its own MQTT client, thus several receivers can run
+        side by side.
 
-def startReceiver(server, port, username, password, queue, topicPrefix='gwmqtt'):
-    global client
-    global wmbusQueue
-    global topic_prefix 
-    topic_prefix=topicPrefix
-    wmbusQueue = queue
-    client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311, transport="tcp")
-    client.on_connect = on_connect
-    client.on_message = on_message
+        With a tracing.Tracer every telegram is put into the queue with its
+        trace started at the reception of the MQTT message.
+        """
+        self.queue = queue
+        self.tracer = tracer
+        self.topic_prefix = topicPrefix
+        self.client = None
 
-    client.username_pw_set(username=username, password=password)
-    print("Connecting...")
-    try:
-        client.connect(server, port, 10)
-        client.loop_start()
-    except Exception as e:
-        return False
-    return True
+    def on_connect(self, client, userdata, flags, rc):
+        print("Connected with result code", rc)
+        # gateways publish compressed batches below the /zlib subtopic
+        client.subscribe([(self.topic_prefix+"/+/out", 0), (self.topic_prefix+"/+/out/zlib", 0)])
+
+    def on_message(self, client, userdata, msg):
+#        print(msg.topic, msg.payload)
+        start = time.perf_counter_ns() if self.tracer is not None else None
+        try:
+            if msg.topic.endswith("/zlib"):
+                payload = json.loads(zlib.decompress(msg.payload).decode('utf-8'))
+            else:
+                payload = json.loads(msg.payload.decode('utf-8'))
+#            print(f"Msg. in: {msg.topic}: {payload}")
+            if 'method' in payload:
+                if payload['method'] == 'wmbus':
+                    telegrams = payload['params']['telegrams']
+                    for telegram in telegrams:
+#                        print(f"WMBUS: {telegram}")
+                        if start is not None:
+                            trace = self.tracer.begin(telegram, start)
+                            trace.attrs['batch'] = len(telegrams)
+                            trace.mark('receive')
+                        if self.queue != None:
+                            self.queue.put(telegram)
+        except Exception as e:
+            print(e)
+
+    def start(self, server, port, username, password):
+        # paho is only needed for live reception, keep it out of offline tools
+        import paho.mqtt.client as mqtt
+        self.client = mqtt.Client(client_id="", clean_session=True, userdata=None, protocol=mqtt.MQTTv311, transport="tcp")
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
 
+        self.client.username_pw_set(username=username, password=password)
+        print("Connecting...")
+        try:
+            self.client.connect(server, port, 10)
+            self.client.loop_start()
+        except Exception as e:
+            return False
+        return True
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+def startReceiver(server, port, username, password, queue, topicPrefix='gwmqtt', tracer=None):
+    """ Starts a GWMQTTReceiver, returns the receiver or False on failure
+    """
+    receiver = GWMQTTReceiver(queue, topicPrefix, tracer)
+    if not receiver.start(server, port, username, password):
+        return False
+    return receiver
@@ -0,0 +1,228 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import time
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from .wmbus import value_dict
+from .wmbus_data_record import descriptor_by_id
+from .batch import json_default
+
+class LatestValueIndex():
+
+    def __init__(self, max_meters=1000000):
+        """ Latest interpreted result per meter serial
+
+        Entries are compact tuples (manufacturer, device type, time, records)
+        where records holds (descriptor id, value) pairs, the descriptors are
+        the interned WMBusRecordDescriptor objects. Secondary indexes map
+        manufacturer and device type (see WMBusFrame.get_device_type()) to
+        the set of serials.
+
+        update() takes no lock: every change is a single dict or set
+        operation, which is atomic in CPython, so decode threads never wait
+        for readers and readers see either the previous or the new entry.
+        At most max_meters serials are kept, the least recently updated one
+        is dropped beyond that. The update order is tracked apart from the
+        entries, which are replaced in place.
+        """
+        self.max_meters = max_meters
+        self.latest = {}
+        # serials, least recently updated first (only used by update())
+        self.order = OrderedDict()
+        self.by_manufacturer = {}
+        self.by_device_type = {}
+        self.updates = 0
+        self.evicted = 0
+
+    def update(self, frame, records, timestamp=None):
+        """ Stores the (descriptor, value) records of a parsed frame
+        """
+        identity = frame.identity
+        if identity is not None:
+            serial, manufacturer, device_type = identity.serial, identity.manufacturer, identity.device_type
+        else:
+            serial = frame.getSerial()
+            manufacturer = frame.get_manufacturer_short()[0:3].decode('UTF-8')
+            device_type = frame.get_device_type().strip()
+        values = tuple((descriptor.id, value.materialise() if hasattr(value, 'materialise') else value)
+                       for descriptor, value in records)
+        entry = (manufacturer, device_type, time.time() if timestamp is None else timestamp, values)
+
+        latest = self.latest
+        previous = latest.get(serial)
+        latest[serial] = entry
+        self.order[serial] = None
+        self.order.move_to_end(serial)
+        self.updates += 1
+
+        if previous is None or previous[0] != manufacturer or previous[1] != device_type:
+            if previous is not None:
+                self._unindex(serial, previous)
+            self.by_manufacturer.setdefault(manufacturer, set()).add(serial)
+            self.by_device_type.setdefault(device_type, set()).add(serial)
+
+            if previous is None and len(latest) > self.max_meters:
+                oldest = self.order.popitem(last=False)[0]
+                dropped = latest.pop(oldest, None)
+                if dropped is not None:
+                    self._unindex(oldest, dropped)
+                    self.evicted += 1
+
+    def _unindex(self, serial, entry):
+        self.by_manufacturer.get(entry[0], set()).discard(serial)
+        self.by_device_type.get(entry[1], set()).discard(serial)
+
+    def get(self, serial, scaled=True):
+        """ Returns the latest result of a meter as dictionary, or None
+        """
+        entry = self.latest.get(serial)
+        return None if entry is None else self.to_dict(serial, entry, scaled)
+
+    def to_dict(self, serial, entry, scaled=True):
+        manufacturer, device_type, timestamp, values = entry
+        return {
+            "serial": serial,
+            "manufacturer": manufacturer,
+            "device_type": device_type,
+            "time": timestamp,
+            "data": [value_dict(descriptor_by_id(id), value, scaled) for id, value in values]
+        }
+
+    def serials(self, manufacturer=None, device_type=None):
+        """ Returns the serials of all meters, optionally restricted
+        """
+        if manufacturer is None and device_type is None:
+            return list(self.latest)
+        selected = None
+        if manufacturer is not None:
+            selected = set(self.by_manufacturer.get(manufacturer, ()))
+        if device_type is not None:
+            serials = set(self.by_device_type.get(device_type, ()))
+            selected = serials if selected is None else selected & serials
+        return list(selected)
+
+    def dump(self, manufacturer=None, device_type=None, scaled=True):
+        """ Yields the latest results of all (selected) meters
+        """
+        latest = self.latest
+        for serial in self.serials(manufacturer, device_type):
+            entry = latest.get(serial)
+            if entry is not None:
+                yield self.to_dict(serial, entry, scaled)
+
+    def get_state(self):
+        """ Returns the entries for a snapshot, oldest first
+        """
+        latest = self.latest
+        return [(serial, latest[serial]) for serial in list(self.order) if serial in latest]
+
+    def set_state(self, state, descriptors):
+        """ Restores the entries of a snapshot
+
+        descriptors maps the descriptor ids of the snapshot to the ids of
+        this process. Meters updated since are kept.
+        """
+        # restored meters are older than the ones updated since
+        for serial, (manufacturer, device_type, timestamp, values) in reversed(state):
+            if serial in self.latest or len(self.latest) >= self.max_meters:
+                continue
+            values = tuple((descriptors[id], value) for id, value in values)
+            self.latest[serial] = (manufacturer, device_type, timestamp, values)
+            self.order[serial] = None
+            self.order.move_to_end(serial, last=False)
+            self.by_manufacturer.setdefault(manufacturer, set()).add(serial)
+            self.by_device_type.setdefault(device_type, set()).add(serial)
+
+    def stats(self):
+        return {
+            "meters": len(self.latest),
+            "manufacturers": len(self.by_manufacturer),
+            "device_types": len(self.by_device_type),
+            "updates": self.updates,
+            "evicted": self.evicted
+        }
+
+class _IndexRequestHandler(BaseHTTPRequestHandler):
+
+    # GET /meters/<serial>, /meters[?manufacturer=..&device_type=..], /stats
+    def do_GET(self):
+        index = self.server.index
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['stats']:
+            return self.send_json(index.stats())
+        if len(parts) == 2 and parts[0] == 'meters':
+            result = index.get(parts[1])
+            if result is None:
+                return self.send_error(404, "Unknown meter")
+            return self.send_json(result)
+        if parts == ['meters']:
+            # bulk dump as NDJSON, written meter by meter
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            for result in index.dump(query.get('manufacturer'), query.get('device_type')):
+                self.wfile.write((json.dumps(result, default=json_default) + '\n').encode('utf-8'))
+            return
+        self.send_error(404)
+
+    def send_json(self, value):
+        body = json.dumps(value, default=json_default).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start_server(index, address):
+    """ Serves an index over HTTP in a background thread
+
+    address is a (host, port) tuple for TCP or the path of a Unix socket.
+    Returns the server, its shutdown() method stops it.
+    """
+    if isinstance(address, str):
+        server = _UnixHTTPServer(address, _IndexRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, _IndexRequestHandler)
+    server.index = index
+    threading.Thread(target=server.serve_forever, name="latest-index", daemon=True).start()
+    return server
@@ -0,0 +1,250 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+from struct import Struct
+
+'''
+Every message on the stream starts with a tag byte and the uint32 length of
+the message body (little endian). Descriptor ids and lengths within the
+body are unsigned LEB128 varints (7 bits per byte, least significant first).
+
+Tag 'D' defines a descriptor id before its first use:
+    id (varint), exponent (int8), then type, sensor and unit as strings
+    (varint length + UTF-8 bytes, unit is empty if the record has no unit)
+
+Tag 'F' holds an interpreted frame:
+    manufacturer (3 ASCII bytes), serial (uint32), timestamp (float64,
+    seconds since the epoch), number of records (varint), followed by the
+    records as descriptor id (varint), value type (uint8) and value. Byte
+    strings (binary and manufacturer specific data) and text are written as
+    varint length + bytes resp. UTF-8 bytes.
+'''
+
+TAG_DESCRIPTOR = 0x44
+TAG_FRAME = 0x46
+
+VALUE_NONE = 0
+VALUE_INT = 1
+VALUE_FLOAT = 2
+VALUE_BYTES = 3
+VALUE_STRING = 4
+
+_MESSAGE = Struct('<BI')
+_EXPONENT = Struct('<b')
+_FRAME = Struct('<3sId')
+_INT = Struct('<q')
+_FLOAT = Struct('<d')
+
+def _pack_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+def _unpack_varint(view, pos):
+    # returns the value and the position behind it
+    value = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _pack_string(text):
+    data = (text or '').encode('utf-8')
+    return _pack_varint(len(data)) + data
+
+class ResultEncoder():
+
+    def __init__(self):
+        """ Encodes interpret() results into a compact binary stream
+
+        The encoder assigns stream local descriptor ids and emits a
+        descriptor definition the first time an id is used, so a decoder
+        which reads the stream from its start always knows every id.
+        Records may be either dictionaries (as returned by getValues()) or
+        (WMBusRecordDescriptor, value) tuples (interpret(descriptors=True)).
+        """
+        self.ids = {}
+
+    def _descriptor_id(self, out, key, type, sensor, unit, exponent):
+        id = self.ids.get(key)
+        if id is None:
+            id = len(self.ids)
+            self.ids[key] = id
+            body = (_pack_varint(id) + _EXPONENT.pack(exponent) + _pack_string(type) + _pack_string(sensor)
+                    + _pack_string(unit))
+            out += _MESSAGE.pack(TAG_DESCRIPTOR, len(body))
+            out += body
+        return id
+
+    def encode(self, result, timestamp=None):
+        """ Returns the binary messages for a single interpret() result
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        out = bytearray()
+        records = bytearray()
+        count = 0
+
+        for record in result['data']:
+            if isinstance(record, tuple):
+                descriptor, value = record
+                id = self._descriptor_id(out, descriptor.key, descriptor.type, descriptor.sensor,
+                                         descriptor.unit, descriptor.exponent)
+            else:
+                value = record['value']
+                id = self._descriptor_id(out, (record['type'], record['sensor']), record['type'],
+                                         record['sensor'], record.get('unit'), 0)
+
+            records += _pack_varint(id)
+            if hasattr(value, 'materialise'):
+                # variable length values are either text or byte strings
+                value = value.materialise()
+            if value is None:
+                records.append(VALUE_NONE)
+            elif isinstance(value, bool) or isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+                records.append(VALUE_INT)
+                records += _INT.pack(value)
+            elif isinstance(value, float):
+                records.append(VALUE_FLOAT)
+                records += _FLOAT.pack(value)
+            elif isinstance(value, (bytes, bytearray, memoryview)):
+                records.append(VALUE_BYTES)
+                records += _pack_varint(len(value))
+                records += value
+            else:
+                data = (value.isoformat() if hasattr(value, 'isoformat') else str(value)).encode('utf-8')
+                records.append(VALUE_STRING)
+                records += _pack_varint(len(data))
+                records += data
+            count += 1
+
+        manufacturer = result['manufacturer'].encode('ascii')
+        serial = int(result['serial'], 16)
+        header = _FRAME.pack(manufacturer, serial, timestamp) + _pack_varint(count)
+
+        out += _MESSAGE.pack(TAG_FRAME, len(header) + len(records))
+        out += header
+        out += records
+        return bytes(out)
+
+class ResultDecoder():
+
+    def __init__(self):
+        """ Decodes a binary stream written by ResultEncoder
+
+        Data can be passed in arbitrary chunks to feed(), which returns the
+        frames which are complete so far.
+        """
+        self.buffer = bytearray()
+        self.descriptors = {}
+
+    def feed(self, data):
+        """ Adds data to the stream and returns the list of complete frames
+
+        Frames are returned as dictionaries similar to interpret() results
+        with an additional "timestamp" and the "unit" of every record.
+        """
+        self.buffer += data
+        frames = []
+        pos = 0
+        view = memoryview(self.buffer)
+
+        try:
+            while len(view) - pos >= _MESSAGE.size:
+                tag, length = _MESSAGE.unpack_from(view, pos)
+                start = pos + _MESSAGE.size
+                if len(view) - start < length:
+                    break
+                pos = start + length
+
+                if tag == TAG_DESCRIPTOR:
+                    self._decode_descriptor(view, start)
+                elif tag == TAG_FRAME:
+                    frames.append(self._decode_frame(view, start))
+                else:
+                    raise ValueError("ResultDecoder: unknown message tag %d" % tag)
+        finally:
+            view.release()
+            del self.buffer[:pos]
+        return frames
+
+    def _decode_descriptor(self, view, pos):
+        id, pos = _unpack_varint(view, pos)
+        exponent = _EXPONENT.unpack_from(view, pos)[0]
+        pos += _EXPONENT.size
+        strings = []
+        for i in range(3):
+            length, pos = _unpack_varint(view, pos)
+            strings.append(bytes(view[pos:pos+length]).decode('utf-8'))
+            pos += length
+        self.descriptors[id] = (strings[0], strings[1], strings[2] or None, exponent)
+
+    def _decode_frame(self, view, pos):
+        manufacturer, serial, timestamp = _FRAME.unpack_from(view, pos)
+        count, pos = _unpack_varint(view, pos + _FRAME.size)
+        data = []
+
+        for i in range(count):
+            id, pos = _unpack_varint(view, pos)
+            value_type = view[pos]
+            pos += 1
+
+            if value_type == VALUE_NONE:
+                value = None
+            elif value_type == VALUE_INT:
+                value = _INT.unpack_from(view, pos)[0]
+                pos += _INT.size
+            elif value_type == VALUE_FLOAT:
+                value = _FLOAT.unpack_from(view, pos)[0]
+                pos += _FLOAT.size
+            else:
+                length, pos = _unpack_varint(view, pos)
+                value = bytes(view[pos:pos+length])
+                pos += length
+                if value_type == VALUE_STRING:
+                    value = value.decode('utf-8')
+
+            type, sensor, unit, exponent = self.descriptors[id]
+            data.append({
+                "type": type,
+                "sensor": sensor,
+                "unit": unit,
+                "value": value
+            })
+
+        return {
+            "manufacturer": manufacturer.decode('ascii'),
+            "serial": "%08x" % serial,
+            "timestamp": timestamp,
+            "data": data
+        }
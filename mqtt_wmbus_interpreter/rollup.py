@@ -0,0 +1,263 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+
+# quantities of cumulative registers, deltas and rates are computed for them
+COUNTER_QUANTITIES = ('Energy', 'Volume', 'Mass', 'Reactive energy', 'On time', 'Operating time')
+
+class _Register():
+
+    __slots__ = ('meta', 'counter', 'start', 'count', 'first', 'last', 'min', 'max',
+                 'delta', 'resets', 'last_time', 'span_start', 'previous')
+
+    def __init__(self, meta, counter):
+        # state of one register of one meter, the open bucket only
+        self.meta = meta
+        self.counter = counter
+        self.start = None
+        self.last_time = None
+        self.previous = None
+
+    def open(self, start, value, timestamp):
+        self.start = start
+        self.count = 1
+        self.first = self.last = self.min = self.max = value
+        self.delta = 0 if self.counter else None
+        self.resets = 0
+        # the consumption of a bucket starts at the last reading before it
+        self.span_start = self.last_time if self.last_time is not None else timestamp
+
+class ConsumptionRollup():
+
+    def __init__(self, bucket=900, lateness=0, output=None, reset_ratio=0.5, idle=None):
+        """ Aggregates interpreted telegrams into time buckets per register
+
+        Every register of every meter keeps the state of its open bucket
+        only: first, last, min and max value, the number of readings and,
+        for cumulative registers (see COUNTER_QUANTITIES), the consumption
+        (delta) and the rate per hour. A bucket is closed once a reading of
+        a later bucket arrives or flush() is called after its end plus
+        lateness seconds. Closed buckets are passed to output.write().
+
+        A counter value below reset_ratio times its predecessor is taken as
+        counter reset (e.g. meter exchange or roll over), the consumption
+        continues from zero. Smaller decreases are taken as a reordered
+        (e.g. duplicated by a second gateway) reading and ignored. Readings
+        older than the last reading of a register update min/max/count of
+        the open bucket but not the consumption; readings of already closed
+        buckets are dropped and counted in late. If a meter is silent for
+        several buckets, its consumption is booked into the bucket of its
+        next reading.
+
+        Registers without readings for idle seconds (default: four buckets,
+        at least a day) are dropped by flush() and counted in evicted, so
+        transient or foreign meters do not accumulate. A meter reappearing
+        later starts afresh, its first bucket has no consumption.
+
+        Values are scaled (see WMBusRecordDescriptor.scale()) if the results
+        carry scaled values or descriptors. Registers are identified by
+        their DIF/VIF bytes, so e.g. the current and the due date value of
+        a meter (storage number 0 resp. 1) are separate registers; buckets
+        carry them as "key" (hex) along with the "unit". Dictionary results
+        lack the DIF/VIF bytes, their records of equal type and sensor are
+        told apart by their order within the telegram and only scaled
+        results (which carry the quantity) are taken as counters.
+        """
+        self.bucket = bucket
+        self.lateness = lateness
+        self.reset_ratio = reset_ratio
+        self.output = output
+        self.idle = max(4 * bucket, 86400) if idle is None else idle
+        self.registers = {}
+        self.late = 0
+        self.emitted = 0
+        self.evicted = 0
+
+    def write(self, result, timestamp=None):
+        """ Sink interface, closed buckets are written to output
+        """
+        for closed in self.update(result, timestamp):
+            self.output.write(closed)
+
+    def update(self, result, timestamp=None):
+        """ Adds an interpret() result received at timestamp (default: now)
+
+        Returns the list of buckets closed by the result.
+        """
+        if result is None:
+            return ()
+        if timestamp is None:
+            timestamp = time.time()
+
+        closed = ()
+        manufacturer = result["manufacturer"]
+        serial = result["serial"]
+        start = timestamp - timestamp % self.bucket
+        registers = self.registers
+
+        seen = None
+        for record in result["data"]:
+            if isinstance(record, tuple):
+                descriptor, value = record
+                key = (manufacturer, serial, descriptor.id)
+                quantity = descriptor.quantity
+                value = descriptor.scale(value)
+                meta = (manufacturer, serial, descriptor.type, descriptor.sensor, descriptor.key.hex(),
+                        descriptor.unit)
+            else:
+                # the n-th record of a type and sensor within the telegram
+                sensor_type, sensor = record["type"], record["sensor"]
+                if seen is None:
+                    seen = {}
+                occurrence = seen.get((sensor_type, sensor), 0)
+                seen[(sensor_type, sensor)] = occurrence + 1
+                key = (manufacturer, serial, sensor_type, sensor, occurrence)
+                quantity = record.get("quantity")
+                value = record.get("scaled", record["value"])
+                meta = (manufacturer, serial, sensor_type, sensor, None, record.get("unit"))
+
+            if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+
+            register = registers.get(key)
+            if register is None:
+                register = registers[key] = _Register(meta, quantity in COUNTER_QUANTITIES)
+
+            if register.start is None:
+                if register.last_time is not None and start + self.bucket <= register.last_time:
+                    # the bucket of the reading was closed by flush()
+                    self.late += 1
+                    continue
+                register.open(start, value, timestamp)
+                self.account(register, value, timestamp)
+            elif start > register.start:
+                if not closed:
+                    closed = []
+                closed.append(self.close(register))
+                register.open(start, value, timestamp)
+                self.account(register, value, timestamp)
+            elif start < register.start:
+                self.late += 1
+                continue
+            else:
+                register.count += 1
+                if value < register.min:
+                    register.min = value
+                if value > register.max:
+                    register.max = value
+                self.account(register, value, timestamp)
+
+        return closed
+
+    def account(self, register, value, timestamp):
+        # book a reading in order of arrival into last value and consumption
+        if register.last_time is not None and timestamp < register.last_time:
+            return
+
+        if register.counter and register.previous is not None:
+            if value >= register.previous:
+                register.delta += value - register.previous
+            elif value < register.previous * self.reset_ratio:
+                register.resets += 1
+                register.delta += value
+            else:
+                return
+        register.last = value
+        register.previous = value
+        register.last_time = timestamp
+
+    def close(self, register):
+        # returns the bucket of a register and marks it closed
+        manufacturer, serial, sensor_type, sensor, key, unit = register.meta
+        rate = None
+        if register.counter and register.last_time > register.span_start:
+            rate = register.delta * 3600.0 / (register.last_time - register.span_start)
+        self.emitted += 1
+        bucket = {
+            "manufacturer": manufacturer,
+            "serial": serial,
+            "type": sensor_type,
+            "sensor": sensor,
+            "key": key,
+            "unit": unit,
+            "start": register.start,
+            "end": register.start + self.bucket,
+            "count": register.count,
+            "first": register.first,
+            "last": register.last,
+            "min": register.min,
+            "max": register.max,
+            "delta": register.delta,
+            "rate": rate,
+            "resets": register.resets
+        }
+        register.start = None
+        return bucket
+
+    def get_state(self):
+        """ Returns the register states for a snapshot
+        """
+        return [(key, tuple(getattr(register, name, None) for name in _Register.__slots__))
+                for key, register in list(self.registers.items())]
+
+    def set_state(self, state, descriptors):
+        """ Restores the register states of a snapshot
+
+        descriptors maps the descriptor ids of the snapshot (part of the
+        register keys of descriptor results) to the ids of this process.
+        """
+        for key, values in state:
+            if len(key) == 3:
+                key = (key[0], key[1], descriptors[key[2]])
+            if key in self.registers:
+                continue
+            register = _Register(None, False)
+            for name, value in zip(_Register.__slots__, values):
+                setattr(register, name, value)
+            self.registers[key] = register
+
+    def flush(self, now=None, force=False):
+        """ Closes all buckets which ended lateness seconds before now
+
+        With force set all open buckets are closed (e.g. on shutdown).
+        Returns the closed buckets, which are written to output as well.
+        Idle registers are dropped.
+        """
+        if now is None:
+            now = time.time()
+        closed = []
+        idle = []
+        for key, register in self.registers.items():
+            if register.start is not None and (force or register.start + self.bucket + self.lateness <= now):
+                closed.append(self.close(register))
+            if register.start is None and register.last_time is not None and register.last_time + self.idle <= now:
+                idle.append(key)
+        for key in idle:
+            del self.registers[key]
+        self.evicted += len(idle)
+        if self.output is not None:
+            for bucket in closed:
+                self.output.write(bucket)
+        return closed
@@ -0,0 +1,236 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+import zlib
+from struct import Struct
+from multiprocessing import shared_memory
+
+from .dispatcher import shard_key
+
+'''
+Layout of the shared memory block
+
+header     magic, slot count, slot size, number of consumers (4 x uint32),
+           write position, full counter (2 x uint64)
+cursors    next sequence number to be read, one uint64 per consumer
+slots      slot count slots of slot size bytes, each starting with the
+           sequence number (uint64), the data length (uint16) and the index
+           of the consumer (uint16) followed by the frame bytes
+
+Sequence numbers increase monotonically, the slot of sequence number n is
+n % slot count. A slot is valid for a reader if its stored sequence number
+matches. The producer publishes a slot by advancing the write position
+after the slot was written, consumers only commit their cursor after a
+frame was processed. Thus a consumer which crashes and is restarted with
+the same index continues with the first frame it did not commit.
+'''
+
+MAGIC = 0x57524E47
+
+_HEADER = Struct('<IIIIQQ')
+_CURSOR = Struct('<Q')
+_SLOT = Struct('<QHH')
+_WRITE_POS = 16
+_FULL_COUNT = 24
+
+class SharedRingBuffer():
+
+    def __init__(self, name=None, slots=4096, slot_size=512, consumers=1, create=False):
+        """ Single producer, multi consumer ring buffer in shared memory
+
+        The producer (e.g. the MQTT receiver) calls write() with raw frame
+        bytes and the index of the consumer process which shall decode it.
+        put() routes a gwmqtt telegram by device address, so the ring can be
+        passed to startReceiver() in place of a queue.
+        Consumers attach to the same block by name and read frames as
+        memoryviews into the shared block with get() and commit() them once
+        processed. No locks are used: the write position is only written by
+        the producer and every cursor only by its consumer.
+
+        With create set a new block is allocated, otherwise the existing
+        block name is attached and its geometry is read from the header.
+        """
+        if create:
+            size = _HEADER.size + consumers * _CURSOR.size + slots * slot_size
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            _HEADER.pack_into(self.shm.buf, 0, MAGIC, slots, slot_size, consumers, 0, 0)
+            for i in range(consumers):
+                _CURSOR.pack_into(self.shm.buf, _HEADER.size + i * _CURSOR.size, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            magic, slots, slot_size, consumers, pos, full = _HEADER.unpack_from(self.shm.buf, 0)
+            if magic != MAGIC:
+                raise ValueError("SharedRingBuffer: %s is not a ring buffer" % name)
+
+        if slot_size <= _SLOT.size:
+            raise ValueError("SharedRingBuffer: slot size too small")
+
+        self.name = self.shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.consumers = consumers
+        self.max_length = slot_size - _SLOT.size
+        self.buf = self.shm.buf
+        self.cursors = _HEADER.size
+        self.data = _HEADER.size + consumers * _CURSOR.size
+        self.owner = create
+
+        # producer side state (write position is cached, we are its only writer)
+        self.write_pos = _CURSOR.unpack_from(self.buf, _WRITE_POS)[0]
+
+    def _cursor(self, index):
+        return _CURSOR.unpack_from(self.buf, self.cursors + index * _CURSOR.size)[0]
+
+    def _slot(self, seq):
+        return self.data + (seq % self.slots) * self.slot_size
+
+    def free(self):
+        """ Returns the number of free slots (producer side)
+        """
+        oldest = min(self._cursor(i) for i in range(self.consumers))
+        return self.slots - (self.write_pos - oldest)
+
+    def write(self, data, consumer=0, timeout=0):
+        """ Writes a frame for the given consumer
+
+        Returns True if the frame was written. If the ring is full, write()
+        waits for up to timeout seconds and returns False if no slot became
+        free. Frames larger than the slot size raise a ValueError.
+        """
+        length = len(data)
+        if length > self.max_length:
+            raise ValueError("SharedRingBuffer: frame of %d bytes exceeds slot size" % length)
+
+        if self.free() <= 0:
+            deadline = time.monotonic() + timeout
+            while self.free() <= 0:
+                if time.monotonic() >= deadline:
+                    full = _CURSOR.unpack_from(self.buf, _FULL_COUNT)[0]
+                    _CURSOR.pack_into(self.buf, _FULL_COUNT, full + 1)
+                    return False
+                time.sleep(0.0005)
+
+        seq = self.write_pos
+        offset = self._slot(seq)
+        start = offset + _SLOT.size
+        self.buf[start:start+length] = data
+        _SLOT.pack_into(self.buf, offset, seq, length, consumer)
+
+        # publish the slot
+        self.write_pos = seq + 1
+        _CURSOR.pack_into(self.buf, _WRITE_POS, self.write_pos)
+        return True
+
+    def put(self, telegram, timeout=0):
+        """ Writes a gwmqtt telegram, routed to a consumer by device address
+
+        All frames of a device are read by the same consumer and thus in
+        order. Returns the result of write().
+        """
+        consumer = zlib.crc32(shard_key(telegram)) % self.consumers
+        return self.write(bytes.fromhex(telegram['data']), consumer, timeout)
+
+    def get(self, consumer=0):
+        """ Returns (sequence number, memoryview) of the next frame or None
+
+        None signals that the ring holds no further frame for the consumer.
+        Frames for other consumers are skipped. The memoryview refers to the
+        shared slot and is only valid until the frame is committed.
+        """
+        write_pos = _CURSOR.unpack_from(self.buf, _WRITE_POS)[0]
+        cursor_offset = self.cursors + consumer * _CURSOR.size
+        seq = _CURSOR.unpack_from(self.buf, cursor_offset)[0]
+
+        while seq < write_pos:
+            offset = self._slot(seq)
+            stored, length, target = _SLOT.unpack_from(self.buf, offset)
+            if stored == seq and target == consumer:
+                start = offset + _SLOT.size
+                return seq, self.buf[start:start+length]
+            # not ours, pass it without processing
+            seq += 1
+            _CURSOR.pack_into(self.buf, cursor_offset, seq)
+
+        return None
+
+    def commit(self, consumer, seq):
+        """ Marks all frames up to seq as processed by the consumer
+        """
+        _CURSOR.pack_into(self.buf, self.cursors + consumer * _CURSOR.size, seq + 1)
+
+    def wait(self, consumer=0, timeout=None, interval=0.0005):
+        """ Like get() but blocks for up to timeout seconds (None: forever)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            entry = self.get(consumer)
+            if entry is not None:
+                return entry
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
+    def stats(self):
+        """ Returns write position, full counter and backlog of every consumer
+        """
+        write_pos = _CURSOR.unpack_from(self.buf, _WRITE_POS)[0]
+        return {
+            "written": write_pos,
+            "full": _CURSOR.unpack_from(self.buf, _FULL_COUNT)[0],
+            "backlog": [write_pos - self._cursor(i) for i in range(self.consumers)]
+        }
+
+    def close(self):
+        """ Detaches from the shared block, the creator also removes it
+        """
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def run_consumer(name, index, handler, stop=None, timeout=0.5):
+    """ Decodes frames of a ring buffer consumer until stop is set
+
+    handler is called with a telegram dictionary whose 'data' is the
+    memoryview of the frame in shared memory (Interpreter.interpret accepts
+    it like a hex string). Frames are committed after the handler returned,
+    even if it raised, so a broken frame does not stall the consumer.
+    """
+    ring = SharedRingBuffer(name)
+    try:
+        while stop is None or not stop.is_set():
+            entry = ring.wait(index, timeout)
+            if entry is None:
+                continue
+            seq, view = entry
+            try:
+                handler({"data": view})
+            except Exception as e:
+                print(e)
+            finally:
+                view.release()
+                ring.commit(index, seq)
+    finally:
+        ring.close()
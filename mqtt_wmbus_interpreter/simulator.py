@@ -0,0 +1,463 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import threading
+from queue import Queue
+from collections import namedtuple
+
+from .gwmqtt_client import GWMQTTReceiver
+from .dispatcher import ShardedDispatcher
+from .wmbus_interpreter import Interpreter
+
+# shares of meter kinds and the manufacturers they are drawn from
+METER_MIX = (('water', 0.6), ('heat', 0.25), ('electricity', 0.15))
+MANUFACTURERS = {
+    'water': ('KAM', 'DME', 'ZRI'),
+    'heat': ('KAM', 'ITW', 'TCH'),
+    'electricity': ('EMH', 'ESY')
+}
+DEVICE_TYPES = {'water': 0x07, 'heat': 0x04, 'electricity': 0x02}
+
+# MQTT message as passed to on_message() by paho
+Message = namedtuple('Message', 'topic payload')
+
+def topic_matches(pattern, topic):
+    """ Returns True if an MQTT topic matches a subscription with + and # wildcards
+    """
+    patterns = pattern.split('/')
+    topics = topic.split('/')
+    for i, level in enumerate(patterns):
+        if level == '#':
+            return True
+        if i >= len(topics) or (level != '+' and level != topics[i]):
+            return False
+    return len(patterns) == len(topics)
+
+class _Session():
+
+    def __init__(self, broker, on_message):
+        # the client object passed to on_connect(), only subscribe() is used
+        self.broker = broker
+        self.on_message = on_message
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for pattern, qos in topics:
+            self.broker.subscriptions.append((pattern, self.on_message))
+
+class LocalBroker():
+
+    def __init__(self):
+        """ In-process stand-in for an MQTT broker
+
+        Published messages are queued and delivered by a single thread to
+        the on_message() callbacks of all matching subscriptions, like the
+        network thread of a paho client does. connect() attaches a
+        GWMQTTReceiver (or any object with on_connect() and on_message()).
+        """
+        self.subscriptions = []
+        self.queue = Queue()
+        self.delivered = 0
+        self.thread = None
+
+    def connect(self, client):
+        client.on_connect(_Session(self, client.on_message), None, {}, 0)
+
+    def publish(self, topic, payload):
+        self.queue.put(Message(topic, payload))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="local-broker", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            msg = self.queue.get()
+            try:
+                if msg is None:
+                    return
+                for pattern, on_message in self.subscriptions:
+                    if topic_matches(pattern, msg.topic):
+                        on_message(None, None, msg)
+                self.delivered += 1
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """ Blocks until all published messages were delivered
+        """
+        self.queue.join()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def depth(self):
+        return self.queue.qsize()
+
+def manufacturer_bytes(code):
+    """ Returns the two (little endian) manufacturer bytes of a three letter code
+    """
+    value = ((ord(code[0]) - 64) << 10) | ((ord(code[1]) - 64) << 5) | (ord(code[2]) - 64)
+    return value.to_bytes(2, 'little')
+
+def _bcd(value, size):
+    return int(str(value % 10**(2*size)), 16).to_bytes(size, 'little')
+
+def meter_records(kind, reading, rng):
+    """ Returns the data records of a reading of a simulated meter
+    """
+    if kind == 'heat':
+        flow = rng.randint(450, 700)
+        return (b'\x0C\x06' + _bcd(1000 + reading * 3, 4) +
+                b'\x0C\x13' + _bcd(50000 + reading * 120, 4) +
+                b'\x0A\x5A' + _bcd(flow, 2) +
+                b'\x0A\x5E' + _bcd(flow - rng.randint(50, 200), 2) +
+                b'\x04\x6D' + bytes([0x00, 0x0C, 0x61, 0x2A]))
+    if kind == 'electricity':
+        return (b'\x0C\x03' + _bcd(200000 + reading * 250, 4) +
+                b'\x04\x2B' + rng.randint(0, 5000).to_bytes(4, 'little'))
+    return (b'\x0C\x13' + _bcd(10000 + reading * 7, 4) +
+            b'\x02\x5B' + rng.randint(5, 25).to_bytes(2, 'little'))
+
+def build_frame(serial, manufacturer, device_type, access_nr, records, key=None):
+    """ Returns a wM-Bus frame (without CRC) with short transport layer header
+
+    With a key the records are encrypted with mode 5 (AES-CBC), the same
+    way WMBusFrame.parse() decrypts them.
+    """
+    address = serial.to_bytes(4, 'little') + bytes([0x01, device_type])
+    mode = 0
+    if key is not None:
+        from Crypto.Cipher import AES
+
+        records = b'\x2F\x2F' + records
+        records += b'\x2F' * (-len(records) % 16)
+        iv = manufacturer + address + bytes([access_nr]) * 8
+        records = AES.new(key, AES.MODE_CBC, iv).encrypt(records)
+        mode = 5
+    # configuration word, number of encrypted blocks and mode
+    config = bytes([(len(records) // 16) << 4 if mode else 0, mode])
+    body = b'\x44' + manufacturer + address + bytes([0x7A, access_nr, 0x00]) + config + records
+    return bytes([len(body)]) + body
+
+class SimMeter():
+
+    __slots__ = ('serial', 'kind', 'key', 'telegrams', 'index')
+
+    def __init__(self, serial, kind, manufacturer, key, readings, rng):
+        """ A meter sending readings cyclically
+
+        The telegrams of the first readings are built up front, so the
+        simulator does not compete for CPU with the receiver it is loading.
+        """
+        self.serial = serial
+        self.kind = kind
+        self.key = key
+        self.index = rng.randrange(readings)
+        self.telegrams = [
+            build_frame(serial, manufacturer_bytes(manufacturer), DEVICE_TYPES[kind], reading & 0xFF,
+                        meter_records(kind, reading, rng), key).hex()
+            for reading in range(readings)
+        ]
+
+    def next_telegram(self):
+        telegram = self.telegrams[self.index]
+        self.index = (self.index + 1) % len(self.telegrams)
+        return telegram
+
+class _Gateway():
+
+    def __init__(self, name, meters, next_publish):
+        self.name = name
+        self.meters = meters
+        self.next = 0
+        self.next_publish = next_publish
+        self.carry = 0.0
+        # telegrams of foreign meters received as well (duplicates)
+        self.pending = []
+
+class Simulator():
+
+    def __init__(self, broker, gateways=100, meters=1000, rate=100, batch_interval=10,
+                 encrypted=0.0, duplicates=0.0, zlib_ratio=0.0, mix=METER_MIX,
+                 prefix='gwmqtt', readings=4, seed=0):
+        """ Impersonates gwmqtt gateways and the meters they receive
+
+        The meters (drawn from mix, a list of (kind, share)) are spread over
+        the gateways. Every gateway publishes a batch of telegrams every
+        batch_interval seconds, all gateways together send rate telegrams
+        per second. A share of encrypted meters sends mode 5 frames (their
+        keys are in self.keys), a share of duplicates telegrams is received
+        by a second gateway as well and zlib_ratio of the messages are
+        compressed and published on the /zlib topic.
+
+        Every telegram carries its publish time (time.perf_counter()) in
+        'sim_ts' for latency measurements.
+        """
+        self.broker = broker
+        self.rate = rate
+        self.batch_interval = batch_interval
+        self.duplicates = duplicates
+        self.zlib_ratio = zlib_ratio
+        self.prefix = prefix
+        self.rng = random.Random(seed)
+        self.keys = {}
+        self.messages = 0
+        self.telegrams = 0
+        self.duplicated = 0
+        self.bytes = 0
+
+        kinds = [kind for kind, share in mix]
+        weights = [share for kind, share in mix]
+        sim_meters = []
+        for i in range(meters):
+            kind = self.rng.choices(kinds, weights)[0]
+            serial = 0x10000000 + i
+            key = None
+            if self.rng.random() < encrypted:
+                key = bytes(self.rng.getrandbits(8) for b in range(16))
+                self.keys['%08x' % serial] = key.hex()
+            sim_meters.append(SimMeter(serial, kind, self.rng.choice(MANUFACTURERS[kind]), key, readings, self.rng))
+
+        now = time.monotonic()
+        self.gateways = [
+            _Gateway("gw%05d" % i, sim_meters[i::gateways] or sim_meters[i % len(sim_meters):][:1],
+                     now + batch_interval * i / gateways)
+            for i in range(gateways)
+        ]
+
+    def publish(self, gateway):
+        """ Publishes the next batch of a gateway
+        """
+        share = self.rate * self.batch_interval / len(self.gateways) + gateway.carry
+        count = int(share)
+        gateway.carry = share - count
+
+        now = time.perf_counter()
+        telegrams = gateway.pending
+        gateway.pending = []
+        for t in telegrams:
+            t['sim_ts'] = now
+        for i in range(count):
+            meter = gateway.meters[gateway.next]
+            gateway.next = (gateway.next + 1) % len(gateway.meters)
+            telegram = {"data": meter.next_telegram(), "sim_ts": now}
+            telegrams.append(telegram)
+            if self.duplicates and self.rng.random() < self.duplicates:
+                self.rng.choice(self.gateways).pending.append({"data": telegram["data"]})
+                self.duplicated += 1
+        if not telegrams:
+            return
+
+        topic = "%s/%s/out" % (self.prefix, gateway.name)
+        payload = json.dumps({"method": "wmbus", "params": {"telegrams": telegrams}}).encode('utf-8')
+        if self.zlib_ratio and self.rng.random() < self.zlib_ratio:
+            topic += "/zlib"
+            payload = zlib.compress(payload)
+
+        self.broker.publish(topic, payload)
+        self.messages += 1
+        self.telegrams += len(telegrams)
+        self.bytes += len(payload)
+
+    def run(self, duration, stop=None, tick=0.01):
+        """ Publishes the batches of all gateways when they are due
+        """
+        end = time.monotonic() + duration
+        while time.monotonic() < end and (stop is None or not stop.is_set()):
+            now = time.monotonic()
+            for gateway in self.gateways:
+                if gateway.next_publish <= now:
+                    gateway.next_publish += self.batch_interval
+                    self.publish(gateway)
+            time.sleep(tick)
+
+class LatencyHistogram():
+
+    # buckets grow by 5 %, starting at 1 microsecond
+    GROWTH = math.log(1.05)
+
+    def __init__(self):
+        """ Fixed size latency histogram
+
+        Percentiles are accurate to about 5 % while the histogram does not
+        grow over a soak, so it does not disturb the RSS measurement.
+        """
+        self.counts = [0] * 512
+        self.count = 0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        index = min(int(math.log(us) / self.GROWTH), 511) if us > 1 else 0
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        """ Returns the p-th percentile in milliseconds
+
+        The value is interpolated within its bucket and never exceeds the
+        largest latency seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = math.exp(index * self.GROWTH) if index else 0.0
+                upper = math.exp((index + 1) * self.GROWTH)
+                us = lower + (upper - lower) * (rank - seen) / n
+                return min(us / 1e3, self.max * 1e3)
+            seen += n
+        return self.max * 1e3
+
+def rss_bytes():
+    """ Returns the resident set size of the process
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class SoakHarness():
+
+    def __init__(self, simulator, workers=1, report_interval=10, output=None):
+        """ Runs a simulator against the receiver and interpreter end to end
+
+        The simulated gateways publish to the simulator's LocalBroker, a
+        GWMQTTReceiver feeds a ShardedDispatcher with workers interpreter
+        threads. Every report_interval seconds throughput, latency
+        percentiles from publishing to the interpreted result and RSS (with
+        its drift since the first report) are printed to output.
+        """
+        self.simulator = simulator
+        self.broker = simulator.broker
+        self.workers = workers
+        self.report_interval = report_interval
+        self.output = output if output is not None else sys.stdout
+        self.total = LatencyHistogram()
+        self.interval = LatencyHistogram()
+        self.interpreters = []
+        self.reports = []
+
+    def handler(self, index):
+        interpreter = Interpreter(debug=0)
+        for device_id, key in self.simulator.keys.items():
+            interpreter.add_key(device_id, key)
+        self.interpreters.append(interpreter)
+
+        def handle(telegram):
+            result = interpreter.interpret(telegram)
+            latency = time.perf_counter() - telegram['sim_ts']
+            self.total.add(latency)
+            self.interval.add(latency)
+            return result
+        return handle
+
+    def report(self, started, last, emitted, baseline):
+        now = time.monotonic()
+        histogram, self.interval = self.interval, LatencyHistogram()
+        rss = rss_bytes()
+        entry = {
+            "elapsed": round(now - started, 1),
+            "throughput": round((self.total.count - emitted) / max(now - last, 1e-9), 1),
+            "p50_ms": round(histogram.percentile(50), 3),
+            "p95_ms": round(histogram.percentile(95), 3),
+            "p99_ms": round(histogram.percentile(99), 3),
+            "max_ms": round(histogram.max * 1e3, 3),
+            "rss_mb": round(rss / 2**20, 1),
+            "rss_drift_mb": round((rss - baseline) / 2**20, 1) if baseline else 0.0,
+            "broker_depth": self.broker.depth(),
+            "failed": sum(i.metrics["failed"] for i in self.interpreters)
+        }
+        self.reports.append(entry)
+        print(json.dumps(entry), file=self.output, flush=True)
+        return now, rss
+
+    def run(self, duration):
+        """ Runs the soak for duration seconds and returns the summary
+        """
+        dispatcher = ShardedDispatcher(self.workers, self.handler)
+        receiver = GWMQTTReceiver(dispatcher, self.simulator.prefix)
+        self.broker.connect(receiver)
+        self.broker.start()
+
+        stop = threading.Event()
+        publisher = threading.Thread(target=self.simulator.run, args=(duration, stop), name="simulator", daemon=True)
+        started = last = time.monotonic()
+        baseline = None
+        emitted = 0
+        publisher.start()
+        try:
+            while publisher.is_alive():
+                publisher.join(max(0.0, last + self.report_interval - time.monotonic()))
+                if time.monotonic() - last >= self.report_interval:
+                    last, rss = self.report(started, last, emitted, baseline)
+                    emitted = self.total.count
+                    baseline = baseline or rss
+        except KeyboardInterrupt:
+            stop.set()
+            publisher.join()
+        finally:
+            self.broker.join()
+            dispatcher.join()
+            self.broker.stop()
+            dispatcher.stop()
+
+        elapsed = time.monotonic() - started
+        rss = rss_bytes()
+        summary = {
+            "elapsed": round(elapsed, 1),
+            "published": self.simulator.telegrams,
+            "duplicates": self.simulator.duplicated,
+            "messages": self.simulator.messages,
+            "emitted": self.total.count,
+            "throughput": round(self.total.count / elapsed, 1),
+            "p50_ms": round(self.total.percentile(50), 3),
+            "p95_ms": round(self.total.percentile(95), 3),
+            "p99_ms": round(self.total.percentile(99), 3),
+            "p999_ms": round(self.total.percentile(99.9), 3),
+            "max_ms": round(self.total.max * 1e3, 3),
+            "rss_mb": round(rss / 2**20, 1),
+            "rss_drift_mb": round((rss - baseline) / 2**20, 1) if baseline else 0.0,
+            "failed": sum(i.metrics["failed"] for i in self.interpreters)
+        }
+        return summary
@@ -0,0 +1,206 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import time
+import pickle
+import threading
+
+from .wmbus_data_record import descriptor_by_key, descriptor_keys
+
+MAGIC = b'WMBUSSNAP'
+VERSION = 1
+
+class StateSnapshot():
+
+    def __init__(self, path, interpreter, rollup=None, interval=60):
+        """ Periodic snapshot of the interpreter state to a local file
+
+        The snapshot holds the keys, learned compact frame layouts, the
+        circuit breaker, the latest value index of the interpreter (if set)
+        and the state of a ConsumptionRollup. restore() loads it on startup,
+        before startReceiver() subscribes, so a restarted process decodes
+        compact frames, rejects broken meters and continues rollups right
+        away.
+
+        The state is taken by poll(), which has to be called regularly by
+        the thread using the interpreter and rollup (e.g. the receive loop),
+        so it is consistent without locking the decode path. Pickling and
+        writing is left to a background thread started by start().
+
+        The file is written to a temporary file which only the owner can
+        read (it holds the AES keys), synced and renamed over the previous
+        snapshot, and the directory is synced, so a crash leaves either the
+        old or the new snapshot. Descriptor ids are process local, the
+        snapshot carries their DIF/VIF keys and ids are mapped to this
+        process on restore.
+        """
+        self.path = path
+        self.interpreter = interpreter
+        self.rollup = rollup
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.condition = threading.Condition()
+        self.pending = None
+        self.taken = time.monotonic()
+        self.thread = None
+        self.saved = 0
+
+    def get_state(self):
+        interpreter = self.interpreter
+        state = {
+            "time": time.time(),
+            "keys": dict(interpreter.keys),
+            "formats": interpreter.formats.get_state()
+        }
+        if interpreter.breaker is not None:
+            state["breaker"] = interpreter.breaker.get_state()
+        if interpreter.index is not None:
+            state["index"] = interpreter.index.get_state()
+        if self.rollup is not None:
+            state["rollup"] = self.rollup.get_state()
+        # taken last, so it covers all ids referred to above
+        state["descriptors"] = descriptor_keys()
+        return state
+
+    def poll(self, now=None):
+        """ Takes the state for the next snapshot once interval has passed
+
+        Must be called by the thread using the interpreter. Returns True if
+        the state was taken.
+        """
+        now = time.monotonic() if now is None else now
+        if now - self.taken < self.interval:
+            return False
+        state = self.get_state()
+        self.taken = now
+        with self.condition:
+            self.pending = state
+            self.condition.notify()
+        return True
+
+    def save(self, state=None):
+        """ Writes a snapshot, returns its size in bytes
+
+        Without state, the state is taken by the calling thread, which must
+        be the one using the interpreter.
+        """
+        if state is None:
+            state = self.get_state()
+        temp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            # left over by a crash of a process with the same pid
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        fd = os.open(temp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC + bytes([VERSION]))
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            os.replace(temp, self.path)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+        # make the rename durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.saved += 1
+        return size
+
+    def restore(self):
+        """ Loads the snapshot if there is one, returns True on success
+
+        State which was built up before restore() is kept, snapshot entries
+        only fill in what is missing.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC) + 1) != MAGIC + bytes([VERSION]):
+                    print("snapshot %s: unknown format, ignored" % self.path)
+                    return False
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print("snapshot %s: %s" % (self.path, e))
+            return False
+
+        interpreter = self.interpreter
+        descriptors = [descriptor_by_key(key).id for key in state["descriptors"]]
+        for device, key in state["keys"].items():
+            interpreter.keys.setdefault(device, key)
+        interpreter.formats.set_state(state["formats"])
+        if interpreter.breaker is not None and "breaker" in state:
+            interpreter.breaker.set_state(state["breaker"])
+        if interpreter.index is not None and "index" in state:
+            interpreter.index.set_state(state["index"], descriptors)
+        if self.rollup is not None and "rollup" in state:
+            self.rollup.set_state(state["rollup"], descriptors)
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stop_event.is_set():
+                    self.condition.wait()
+                state, self.pending = self.pending, None
+            if state is None:
+                return
+            try:
+                self.save(state)
+            except Exception as e:
+                print("snapshot %s: %s" % (self.path, e))
+
+    def start(self):
+        """ Starts writing the snapshots taken by poll()
+        """
+        self.thread = threading.Thread(target=self.run, name="snapshot", daemon=True)
+        self.thread.start()
+
+    def stop(self, save=True):
+        """ Stops the periodic snapshots and writes a last one
+
+        Called by the thread using the interpreter, which takes the last
+        state.
+        """
+        with self.condition:
+            self.stop_event.set()
+            self.pending = None
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if save:
+            self.save()
@@ -0,0 +1,280 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+import sqlite3
+import threading
+from queue import Queue, Empty, Full
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    manufacturer TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    UNIQUE (manufacturer, serial)
+);
+CREATE TABLE IF NOT EXISTS descriptors (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    type TEXT NOT NULL,
+    sensor TEXT NOT NULL,
+    quantity TEXT,
+    unit TEXT,
+    UNIQUE (key, type, sensor)
+);
+CREATE TABLE IF NOT EXISTS readings (
+    time REAL NOT NULL,
+    device INTEGER NOT NULL REFERENCES devices (id),
+    descriptor INTEGER NOT NULL REFERENCES descriptors (id),
+    value,
+    scaled REAL
+);
+CREATE INDEX IF NOT EXISTS readings_device_time ON readings (device, time);
+CREATE TABLE IF NOT EXISTS rollups (
+    device INTEGER NOT NULL REFERENCES devices (id),
+    descriptor INTEGER NOT NULL REFERENCES descriptors (id),
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    count INTEGER,
+    first REAL,
+    last REAL,
+    min REAL,
+    max REAL,
+    delta REAL,
+    rate REAL,
+    resets INTEGER,
+    PRIMARY KEY (device, descriptor, start)
+);
+'''
+
+INSERT_READING = 'INSERT INTO readings (time, device, descriptor, value, scaled) VALUES (?, ?, ?, ?, ?)'
+INSERT_ROLLUP = ('INSERT OR REPLACE INTO rollups (device, descriptor, start, end, count, first, last, min, max, '
+                 'delta, rate, resets) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# marker which tells the writer to flush and terminate
+_STOP = object()
+
+def _sql_value(value):
+    # SQLite stores numbers, text and blobs; dates as ISO 8601 text
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if hasattr(value, 'materialise'):
+        value = value.materialise()
+        return value if isinstance(value, str) else bytes(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+class SQLiteSink():
+
+    def __init__(self, path, batch_size=5000, max_age=1.0, queue_size=100000):
+        """ Stores interpreted telegrams and rollup buckets in SQLite
+
+        write() only queues the result, a dedicated writer thread inserts
+        the records with executemany() in one transaction per batch. A batch
+        is written once it holds batch_size readings or its oldest reading
+        is max_age seconds old. The database runs in WAL mode, devices and
+        descriptors are stored once and readings refer to them by id.
+        Descriptors are identified by their DIF/VIF bytes (hex "key"), so
+        e.g. storage numbers and tariffs of a register are kept apart. Only
+        descriptor results and rollup buckets carry these bytes, records of
+        dictionary results are stored with an empty key.
+
+        At most queue_size results are pending. If the writer falls behind,
+        write() blocks until there is room again (backpressure); the time
+        spent waiting is reported by stats(). A batch which cannot be
+        written is dropped and logged, the writer carries on with the next
+        one. Should the writer thread die nevertheless, write() raises
+        instead of blocking forever.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.queue = Queue(queue_size)
+        self.metrics = {
+            "results": 0,
+            "readings": 0,
+            "rollups": 0,
+            "batches": 0,
+            "errors": 0,
+            "dropped": 0,
+            "write_ms_last": 0.0,
+            "write_ms_max": 0.0,
+            "write_ms_total": 0.0,
+            "blocked": 0,
+            "blocked_s": 0.0
+        }
+        self.devices = {}
+        self.descriptors = {}
+        self.thread = threading.Thread(target=self.run, name="sqlite-sink", daemon=True)
+        self.thread.start()
+
+    def write(self, result, timestamp=None):
+        """ Queues an interpret() result or a rollup bucket
+        """
+        if result is None:
+            return
+        data = result.get("data")
+        if data is not None and not isinstance(data, list):
+            # streamed records have to be decoded before they are queued
+            result = dict(result, data=list(data))
+        item = (result, time.time() if timestamp is None else timestamp)
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            started = time.monotonic()
+            while True:
+                if not self.thread.is_alive():
+                    raise RuntimeError("SQLiteSink: writer thread of %s is not running" % self.path)
+                try:
+                    self.queue.put(item, timeout=1.0)
+                    break
+                except Full:
+                    pass
+            self.metrics["blocked"] += 1
+            self.metrics["blocked_s"] += time.monotonic() - started
+
+    def device_id(self, cursor, manufacturer, serial):
+        key = (manufacturer, serial)
+        id = self.devices.get(key)
+        if id is None:
+            cursor.execute('INSERT OR IGNORE INTO devices (manufacturer, serial) VALUES (?, ?)', key)
+            id = cursor.execute('SELECT id FROM devices WHERE manufacturer = ? AND serial = ?', key).fetchone()[0]
+            self.devices[key] = id
+        return id
+
+    def descriptor_id(self, cursor, key, sensor_type, sensor, quantity=None, unit=None):
+        key = (key or '', sensor_type, sensor)
+        id = self.descriptors.get(key)
+        if id is None:
+            cursor.execute('INSERT OR IGNORE INTO descriptors (key, type, sensor, quantity, unit) '
+                           'VALUES (?, ?, ?, ?, ?)', key + (quantity, unit))
+            id = cursor.execute('SELECT id FROM descriptors WHERE key = ? AND type = ? AND sensor = ?',
+                                key).fetchone()[0]
+            self.descriptors[key] = id
+        return id
+
+    def rows(self, cursor, batch):
+        # normalises a batch of results into reading and rollup rows
+        readings = []
+        rollups = []
+        for result, timestamp in batch:
+            device = self.device_id(cursor, result["manufacturer"], result["serial"])
+            if "data" not in result:
+                descriptor = self.descriptor_id(cursor, result.get("key"), result["type"], result["sensor"],
+                                                unit=result.get("unit"))
+                rollups.append((device, descriptor, result["start"], result["end"], result["count"],
+                                result["first"], result["last"], result["min"], result["max"],
+                                result["delta"], result["rate"], result["resets"]))
+                continue
+            for record in result["data"]:
+                if isinstance(record, tuple):
+                    d, value = record
+                    descriptor = self.descriptor_id(cursor, d.key.hex(), d.type, d.sensor, d.quantity, d.unit)
+                    scaled = d.scale(value)
+                else:
+                    descriptor = self.descriptor_id(cursor, None, record["type"], record["sensor"],
+                                                    record.get("quantity"), record.get("unit"))
+                    value = record["value"]
+                    scaled = record.get("scaled")
+                readings.append((timestamp, device, descriptor, _sql_value(value),
+                                 scaled if isinstance(scaled, (int, float)) else None))
+        return readings, rollups
+
+    def flush(self, connection, batch):
+        started = time.perf_counter()
+        try:
+            with connection:
+                cursor = connection.cursor()
+                readings, rollups = self.rows(cursor, batch)
+                cursor.executemany(INSERT_READING, readings)
+                cursor.executemany(INSERT_ROLLUP, rollups)
+        except Exception as e:
+            # the transaction was rolled back, ids cached within it are void
+            self.metrics["errors"] += 1
+            self.metrics["dropped"] += len(batch)
+            self.devices.clear()
+            self.descriptors.clear()
+            print("SQLiteSink: batch of %d results dropped: %s" % (len(batch), e))
+            return
+
+        elapsed = (time.perf_counter() - started) * 1e3
+        metrics = self.metrics
+        metrics["results"] += len(batch)
+        metrics["readings"] += len(readings)
+        metrics["rollups"] += len(rollups)
+        metrics["batches"] += 1
+        metrics["write_ms_last"] = elapsed
+        metrics["write_ms_max"] = max(metrics["write_ms_max"], elapsed)
+        metrics["write_ms_total"] += elapsed
+
+    def run(self):
+        connection = sqlite3.connect(self.path, cached_statements=64)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+
+        batch = []
+        size = 0
+        deadline = None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is _STOP:
+                    stop = True
+                else:
+                    if not batch:
+                        deadline = time.monotonic() + self.max_age
+                    batch.append(item)
+                    data = item[0].get("data")
+                    size += len(data) if data is not None else 1
+            except Empty:
+                pass
+
+            if batch and (stop or size >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(connection, batch)
+                batch = []
+                size = 0
+                deadline = None
+
+        connection.close()
+
+    def close(self):
+        """ Writes all pending results and stops the writer
+        """
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+        self.thread.join()
+
+    def stats(self):
+        """ Returns the metrics, the mean write latency and the queue depth
+        """
+        stats = dict(self.metrics)
+        stats["write_ms_mean"] = stats["write_ms_total"] / max(stats["batches"], 1)
+        stats["pending"] = self.queue.qsize()
+        return stats
@@ -0,0 +1,201 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+from array import array
+
+# function codes of the C-field (see WMBusFrame.get_function_code())
+FUNCTION_CODES = {
+    'SND-NKE': 0x0,
+    'SND-UD': 0x3,
+    'SND-NR': 0x4,
+    'SND-IR': 0x6,
+    'ACC-NR': 0x7,
+    'ACC-DMD': 0x8,
+    'REQ-UD1': 0xA,
+    'REQ-UD2': 0xB
+}
+
+# rule which set the interval of a throttled telegram
+REASONS = ('default', 'device', 'medium', 'function')
+_DEFAULT, _DEVICE, _MEDIUM, _FUNCTION = range(4)
+
+class DeviceThrottle():
+
+    def __init__(self, devices=None, media=None, functions=None, default=0.0):
+        """ Enforces a minimum interval between decoded telegrams of a device
+
+        Intervals (in seconds) are configured per device serial, per medium
+        (as returned by WMBusFrame.get_device_type(), e.g. 'Water') and per
+        function code (e.g. 'SND-IR' for meters in installation mode), with
+        default for all other devices. A device interval takes precedence
+        over the medium one, a function code interval applies if it is
+        longer.
+
+        admit() is called with the DeviceIdentity and C-field of a telegram,
+        i.e. before anything but the link layer header was looked at. Of the
+        telegrams arriving within the interval only the most recent one is
+        held; release() hands it out once the interval has passed. All other
+        telegrams are dropped and counted by the reason (see REASONS) whose
+        interval applied. Held telegrams are copied with their frame as
+        bytes, as e.g. the memoryview of a SharedRingBuffer slot is only
+        valid until its handler returns.
+
+        The time of the last admitted telegram and the resolved interval of
+        every device are kept in arrays indexed by DeviceIdentity.id.
+        """
+        self.devices = dict(devices or {})
+        self.media = dict(media or {})
+        self.default = default
+        self.functions = [0.0] * 16
+        for name, interval in (functions or {}).items():
+            self.functions[FUNCTION_CODES[name]] = interval
+
+        self.last = array('d')
+        self.intervals = array('d')
+        self.reasons = array('b')
+        # most recent held telegram by device id: (telegram, due, reason)
+        self.pending = {}
+        # earliest due time of the pending telegrams (may be too early)
+        self.due = float('inf')
+        self.held = 0
+        self.superseded = 0
+        self.dropped = dict.fromkeys(REASONS, 0)
+
+    def grow(self, size):
+        missing = size - len(self.last)
+        self.last.extend([float('-inf')] * missing)
+        self.intervals.extend([-1.0] * missing)
+        self.reasons.extend([0] * missing)
+
+    def resolve(self, identity):
+        # interval of a device from its serial or medium, cached by id
+        if identity.serial in self.devices:
+            return self.devices[identity.serial], _DEVICE
+        if identity.device_type in self.media:
+            return self.media[identity.device_type], _MEDIUM
+        return self.default, _DEFAULT
+
+    def admit(self, identity, control, telegram, now=None):
+        """ Returns True if the telegram is to be decoded now
+
+        Otherwise the telegram was either dropped or is held as the most
+        recent telegram of the device.
+        """
+        id = identity.id
+        if id >= len(self.last):
+            self.grow(id + 1)
+
+        interval = self.intervals[id]
+        if interval < 0:
+            interval, reason = self.resolve(identity)
+            self.intervals[id] = interval
+            self.reasons[id] = reason
+        else:
+            reason = self.reasons[id]
+
+        function_interval = self.functions[control & 0x0F]
+        if function_interval > interval:
+            interval = function_interval
+            reason = _FUNCTION
+        if interval <= 0:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        last = self.last[id]
+        held = self.pending.pop(id, None)
+        if held is not None:
+            # superseded by this telegram
+            self.dropped[REASONS[held[2]]] += 1
+            self.superseded += 1
+
+        if now - last >= interval:
+            self.last[id] = now
+            return True
+
+        held = dict(telegram)
+        held.pop('trace', None)
+        if not isinstance(held['data'], str):
+            held['data'] = bytes(held['data'])
+        due = last + interval
+        self.pending[id] = (held, due, reason)
+        if due < self.due:
+            self.due = due
+        self.held += 1
+        return False
+
+    def release(self, now=None):
+        """ Returns the held telegrams whose interval has passed
+
+        Cheap to call for every telegram, the pending telegrams are only
+        looked at once the earliest of them is due.
+        """
+        if not self.pending:
+            return []
+        if now is None:
+            now = time.monotonic()
+        if now < self.due:
+            return []
+        released = []
+        earliest = float('inf')
+        for id, (telegram, due, reason) in list(self.pending.items()):
+            if due <= now:
+                del self.pending[id]
+                self.last[id] = now
+                released.append(telegram)
+            elif due < earliest:
+                earliest = due
+        self.due = earliest
+        return released
+
+    def stats(self):
+        return {
+            "devices": len(self.last),
+            "held": self.held,
+            "pending": len(self.pending),
+            "dropped": dict(self.dropped)
+        }
+
+def parse_rules(rules):
+    """ Returns DeviceThrottle arguments from NAME=SECONDS rules
+
+    NAME is a function code (e.g. SND-IR), a device serial (8 hex digits),
+    'default' or otherwise a medium (e.g. Water).
+    """
+    devices, media, functions, default = {}, {}, {}, 0.0
+    for rule in rules:
+        name, sep, seconds = rule.rpartition('=')
+        if not sep:
+            raise ValueError("throttle rule %s is not NAME=SECONDS" % rule)
+        seconds = float(seconds)
+        if name in FUNCTION_CODES:
+            functions[name] = seconds
+        elif name == 'default':
+            default = seconds
+        elif len(name) == 8 and all(c in '0123456789abcdefABCDEF' for c in name):
+            devices[name.lower()] = seconds
+        else:
+            media[name] = seconds
+    return {"devices": devices, "media": media, "functions": functions, "default": default}
@@ -0,0 +1,146 @@
+"""
+MIT License
+
+Copyright (c) 2013 Cyrill Brunschwiler, 2023 Ralf Glaser
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import time
+import threading
+from collections import deque
+
+class Trace():
+
+    __slots__ = ('tracer', 'id', 'sampled', 'start', 'wall', 'marks', 'attrs')
+
+    def __init__(self, tracer, id, sampled, start):
+        """ Timing of one telegram on its way through the pipeline
+
+        Every stage calls mark() with its name when it is done, the duration
+        of a stage is the time since the previous mark. Telegrams carry their
+        trace in telegram['trace'].
+        """
+        self.tracer = tracer
+        self.id = id
+        self.sampled = sampled
+        self.start = start
+        self.wall = time.time()
+        self.marks = []
+        self.attrs = {}
+
+    def mark(self, stage):
+        """ Records the end of a stage
+        """
+        self.marks.append((stage, time.perf_counter_ns()))
+
+    def finish(self, stage='sink'):
+        """ Marks the last stage and hands the trace to its tracer
+        """
+        self.marks.append((stage, time.perf_counter_ns()))
+        self.tracer.finish(self)
+
+    def to_dict(self):
+        stages = []
+        last = self.start
+        for stage, at in self.marks:
+            stages.append([stage, (at - last) / 1e6])
+            last = at
+        return {
+            "id": self.id,
+            "time": self.wall,
+            "sampled": self.sampled,
+            "total_ms": (last - self.start) / 1e6,
+            "stages": stages,
+            "attrs": self.attrs
+        }
+
+class Tracer():
+
+    def __init__(self, sample=1000, slow_ms=100, ring_size=1000, path=None):
+        """ Samples per telegram traces
+
+        Every sample-th telegram is traced in detail, including the stages
+        of WMBusFrame.parse() (sample 0 disables sampling). All other
+        telegrams only record the coarse pipeline stages (receive, queue,
+        interpret, sink) and are kept only if they took longer than slow_ms
+        (None keeps no slow traces).
+
+        Kept traces go into an in-memory ring of ring_size traces, which
+        can be written with dump(), and are appended to the NDJSON file path
+        if given.
+        """
+        self.sample = sample
+        self.slow_ns = None if slow_ms is None else int(slow_ms * 1e6)
+        self.ring = deque(maxlen=ring_size)
+        self.path = path
+        self.count = 0
+        self.kept = 0
+        self.lock = threading.Lock()
+
+    def begin(self, telegram, start=None):
+        """ Starts the trace of a telegram and stores it in telegram['trace']
+
+        start is the perf_counter_ns() the message holding the telegram was
+        received at, by default the trace starts now.
+        """
+        self.count += 1
+        sampled = self.sample > 0 and self.count % self.sample == 0
+        trace = Trace(self, self.count, sampled, time.perf_counter_ns() if start is None else start)
+        telegram['trace'] = trace
+        return trace
+
+    def finish(self, trace):
+        """ Keeps the trace if it was sampled or is a slow outlier
+        """
+        end = trace.marks[-1][1] if trace.marks else time.perf_counter_ns()
+        slow = self.slow_ns is not None and end - trace.start >= self.slow_ns
+        if not trace.sampled and not slow:
+            return
+
+        entry = trace.to_dict()
+        entry["slow"] = slow
+        self.ring.append(entry)
+        self.kept += 1
+        if self.path is not None:
+            with self.lock:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def traces(self):
+        """ Returns the traces currently held by the ring, oldest first
+        """
+        return list(self.ring)
+
+    def dump(self, path):
+        """ Writes the traces of the ring to an NDJSON file
+        """
+        traces = self.traces()
+        with open(path, 'w') as f:
+            for entry in traces:
+                f.write(json.dumps(entry) + '\n')
+        return len(traces)
+
+def finish(telegram, stage='sink'):
+    """ Finishes the trace of a telegram if it carries one
+    """
+    trace = telegram.get('trace') if isinstance(telegram, dict) else None
+    if trace is not None:
+        trace.finish(stage)
@@ -22,7 +22,6 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import serial 
 from array import array
 
 # global variables
@@ -36,6 +35,8 @@ def connect_sniffer(port):
 	FTDI based wireless M-Bus sniffer devices that deliver sniffed wM-Bus
 	frames as continuous stream at the tty
 	"""
+	import serial
+	
 	ser = serial.Serial(
 		port=port,
 		baudrate=9600,
@@ -51,17 +52,21 @@ def connect_sniffer(port):
 	
 	return ser
 
-def loadsample(path):
+def loadsample(path, verbose=None):
 	""" Load sample frame from file specified by path.
 	
 	The method supports to load captured wireless M-Bus frames from files for 
-	any debugging or replay purposes
+	any debugging or replay purposes. The file contents are printed if 
+	verbose is set (defaults to the module debug flag).
 	"""
+	if verbose is None:
+		verbose = debug
+	
 	
 	f = open(path,'rb')
 	a = array('B', f.read())
 	
-	if debug:
+	if verbose:
 		print ('-- file contents --')
 		print (a)
 		print ('-- eof --')
@@ -27,17 +27,54 @@ from . import util
 
 from array import array
 from datetime import datetime
-from Crypto.Cipher import AES
 
 debug = 1
 
-from .wmbus_data_record import WMBusDataRecordHeader, WMBusDataRecord
+from .wmbus_data_record import WMBusDataRecordHeader, WMBusDataRecord, decode_values, lvar_length
+from .format_cache import layout_entry
+from .errors import FrameLengthError, TruncatedFrameError, DecryptionError, MissingKeyError, UnknownFormatError
 from .wmbus_data_header import WMBusShortDataHeader, WMBusLongDataHeader
 
+def peek_address(arr):
+    """ Returns the address field of a raw frame without parsing it
+
+    The six address bytes (device id, version and device type) are read
+    straight from the link layer header. This is the same information that
+    WMBusFrame.parse() stores in WMBusFrame.address, but it is available
+    before any decryption or record parsing work is spent on the frame.
+    """
+    return bytes(arr[4:10])
+
+def peek_device_key(arr):
+    """ Returns manufacturer and address bytes of a raw frame without parsing
+
+    The result equals WMBusFrame.get_device_key() of the parsed frame.
+    """
+    return bytes(arr[2:10])
+
+def value_dict(descriptor, value, scaled=False):
+    """ Returns the dictionary representation of a decoded record
+    """
+    recData = {
+        "type": descriptor.type,
+        "sensor": descriptor.sensor,
+        "value": value,
+#        "org": ' '.join(format(x, '02x') for x in val)
+    }
+    if scaled:
+        recData["vif"] = descriptor.vif_code
+        recData["quantity"] = descriptor.quantity
+        recData["unit"] = descriptor.unit
+        recData["scaled"] = descriptor.scale(value)
+    return recData
+
 class WMBusFrame():
 
     def __init__(self, *args, **kwargs):
 
+        # debug output can be enabled per frame, defaults to the module flag
+        self.debug = kwargs.get('debug', debug)
+
         # just holds the most usefull wireless M-Bus frame params
         self.length = None
         self.control = None
@@ -47,10 +84,18 @@ class WMBusFrame():
         self.header = None
         self.records = []
         self.data = None
+        self.payload = None
         self.data_size = None
         self.key = None
+        self.format_signature = None
+        self.formats = None
+        self.layout = None
+        # tracing.Trace of a sampled telegram, the parse stages are marked
+        self.trace = None
+        # DeviceIdentity of the sender, if known before parsing
+        self.identity = None
     
-    def parse(self, arr, keys=None):
+    def parse(self, arr, keys=None, formats=None, lazy=False):
         """ Parses frame contents and initializes object values
         
         The first steps of setting up an WMBusFrame should be the 
@@ -64,6 +109,14 @@ class WMBusFrame():
             '\x57\x00\x00\x44': '\xCA\xFE\xBA\xBE\x12\x34\x56\x78\x9A\xBC\xDE\xF0\xCA\xFE\xBA\xBE',
             '\x00\x00\x00\x00': '\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF'
         }
+        
+        The optional formats argument takes a WMBusFormatCache. The layouts
+        of full frames are learned into the cache and compact frames are
+        decoded with the layout matching their format signature.
+        
+        If lazy is set, parsing stops once the payload is decrypted and the
+        records are only parsed while iterating iter_records() resp.
+        iter_values(). self.records stays empty in that case.
         """
 
         if len(arr)-1 != arr[0]:
@@ -102,8 +155,15 @@ class WMBusFrame():
                 
             self.data_size = len(self.data)
             
+            trace = self.trace
+            if trace is not None:
+                trace.mark('header')
+            
             if (keys):
-                devid = ''.join(chr(b) for b in self.get_device_id()) 
+                if self.identity is not None:
+                    devid = self.identity.device_id
+                else:
+                    devid = ''.join(chr(b) for b in self.get_device_id())
                 self.key = keys.get(devid, None)
             
             # time might come where we should move this into a function
@@ -111,18 +171,40 @@ class WMBusFrame():
                 
                 # data is encrypted. thus, check if a key was specified
                 if (self.key):
+                    from Crypto.Cipher import AES
+                    
+                    # keys may still be configured as latin-1 strings
+                    key = self.key.encode('latin-1') if isinstance(self.key, str) else bytes(self.key)
                     
-                    # setup cipher specs, decrypt and strip padding
-                    spec = AES.new(self.key, AES.MODE_CBC, "%s" % self.get_iv())
-                    self.data = bytearray(spec.decrypt("%s" % self.data))
+                    # setup cipher specs and decrypt all complete blocks,
+                    # a trailing partial block is transmitted unencrypted
+                    spec = AES.new(key, AES.MODE_CBC, bytes(self.get_iv()))
+                    size = len(self.data) - len(self.data) % 16
+                    self.data = bytearray(spec.decrypt(bytes(self.data[0:size]))) + self.data[size:]
                    
-                    if debug:
+                    if self.debug:
                         print (f"dec: {util.tohex(self.data)}")
                     
                     # check whether the first two bytes are 2F
-                    if (self.data[0:2] != '\x2F\x2F'):
-                        print (util.tohex(self.data))
-                        raise Exception("Decryption failed")
+                    if (self.data[0:2] != b'\x2F\x2F'):
+                        if self.debug:
+                            print (util.tohex(self.data))
+                        raise DecryptionError("Decryption failed")
+                else:
+                    raise MissingKeyError("No key for encrypted frame of device %s" % self.getSerial())
+            
+            if trace is not None:
+                trace.mark('decrypt')
+            
+            self.formats = formats
+            
+            if (self.is_compact()):
+                self.parse_compact()
+                if not lazy:
+                    self.records.extend(self.iter_records())
+                if trace is not None:
+                    trace.mark('records')
+                return
             
 #            print(f"RGL: self.data: {' '.join(format(x, '02x') for x in self.data)}")
             start=0
@@ -135,17 +217,139 @@ class WMBusFrame():
 #            print(f"RGL: self.data: {' '.join(format(x, '02x') for x in self.data)}")
 #            self.data = bytearray(self.data.lstrip('\x2F').rstrip('\x2F'))
 
-            if debug:
+            if self.debug:
                 print (f"cut: {util.tohex(self.data)}")
 
-            while len(self.data) > 0:
-                record = WMBusDataRecord()
-                self.data = record.parse(self.data)            
-                self.records.append(record)
+            self.payload = self.data
+            if not lazy:
+                self.records.extend(self.iter_records())
+            if trace is not None:
+                trace.mark('records')
         else:
             print ("(%d) " % arr[0] + util.tohex(arr) )
-            raise Exception("Invalid frame length")
+            raise FrameLengthError("Invalid frame length")
+            
+    def iter_records(self):
+        """ Yields the data records of the frame one at a time
+
+        Records are parsed from the payload while iterating, so only the
+        current record is held unless the caller keeps it. Frames parsed
+        without lazy yield their already parsed records. Once the records of
+        a full frame are exhausted its layout is learned into the format
+        cache passed to parse().
+        """
+        if self.records:
+            yield from self.records
+        elif self.layout is not None:
+            yield from self._iter_compact_records()
+        else:
+            yield from self._iter_full_records()
+
+    def _iter_full_records(self):
+        # records are parsed in place, their values are located by offset
+        payload = self.payload
+        layout = [] if self.formats is not None else None
+        offset = 0
+        while offset < len(payload):
+            if payload[offset] == 0x2F:
+                # idle filler between records
+                offset += 1
+                continue
+            record = WMBusDataRecord()
+            offset = record.parse_at(payload, offset)
+            if layout is not None:
+                layout.append(layout_entry(record.header))
+            yield record
+        self.data = payload[offset:]
+        
+        if layout is not None:
+            self.format_signature = self.formats.learn_layout(self.get_device_key(), tuple(layout))
+
+    def iter_values(self, scaled=False, descriptors=False):
+        """ Yields the decoded records one at a time
+
+        The records are the same dictionaries as returned by getValues(),
+        resp. (descriptor, value) tuples if descriptors is set.
+        """
+        for rec in self.iter_records():
+            header = rec.header
+            descriptor = header.get_descriptor()
+            value = header.getDataValue(rec.value)
+            
+            if descriptors:
+                yield (descriptor, value)
+            else:
+                yield value_dict(descriptor, value, scaled)
+
+    def parse_compact(self):
+        """ Looks up the learned layout of a compact frame
+
+        The application data of a compact frame starts with the format
+        signature and the CRC of the equivalent full frame (2 bytes each,
+        little endian), followed by the record values only. The values are
+        parsed with the layout by iter_records().
+        """
+        formats = self.formats
+        data = self.data
+        start = 0
+        
+        # skip the verification fillers of decrypted data
+        while start < 2 and start < len(data) and data[start] == 0x2F:
+            start += 1
+        
+        if len(data) < start + 4:
+            raise TruncatedFrameError("Compact frame too short")
+        
+        self.format_signature = data[start] | (data[start+1] << 8)
+        layout = formats.get(self.get_device_key(), self.format_signature) if formats is not None else None
+        
+        if layout is None:
+            raise UnknownFormatError("Unknown format signature %04X" % self.format_signature)
+        
+        self.payload = data[start+4:]
+        self.layout = layout
+
+    def _iter_compact_records(self):
+        offset = 0
+        
+        for dif, vif, vif_text, vif_text_length in self.layout:
+            record = WMBusDataRecord()
+            header = record.header
+            header.dif[:] = dif
+            header.vif[:] = vif
+            header.vif_text = vif_text
+            header.vif_text_length = vif_text_length
+            
+            if header.is_manufacturer_specific():
+                length = len(self.payload) - offset
+            elif header.get_data_type() == WMBusDataRecordHeader.DATA_TYPE_VARIABLE:
+                header.lvar = self.payload[offset]
+                offset += 1
+                length = lvar_length(header.lvar)
+            else:
+                length = max(header.get_data_len(None), 0)
             
+            if offset + length > len(self.payload):
+                raise TruncatedFrameError("Compact frame does not match its layout")
+            
+            header.value_offset = offset
+            record.offset = offset
+            record.value = memoryview(self.payload)[offset:offset+length]
+            offset += length
+            yield record
+        
+        self.data = self.payload[offset:]
+        
+    def is_compact(self):
+        """ Returns True if the CI field indicates a compact frame
+        """
+        return self.control_information in (0x73, 0x79, 0x7B)
+        
+    def get_device_key(self):
+        """ Returns manufacturer and address bytes identifying the device
+        """
+        return bytes(self.manufacturer) + bytes(self.address)
+        
     def get_manufacturer_short(self):
         """ Returns the three letter manufacturer code
         
@@ -247,7 +451,7 @@ class WMBusFrame():
                 
                 if verb >= 2:
                     for rec in self.records:
-                         val = rec.value.copy()
+                         val = bytearray(rec.value)
                          val.reverse()
                         
                          line += '\nDIFs:\t' + util.tohex(rec.header.dif) 
@@ -270,20 +474,36 @@ class WMBusFrame():
         '''
         print (line)
 
-    def getValues(self):
+    def getValues(self, scaled=False):
+        """ Returns the decoded records as a list of dictionaries
+
+        If scaled is set, every record additionally carries the compact VIF
+        code ("vif", see WMBusDataRecordHeader.get_vif_code()), the physical
+        "quantity" and "unit" and the "scaled" value with the VIF exponent
+        already applied.
+        """
         valList = []
-        for rec in self.records:
-            val = rec.value.copy()
-#            val.reverse()
-            recData = {
-                "type": rec.header.get_function_field_name(),
-                "sensor": rec.header.get_vif_description(),
-                "value": rec.header.getDataValue(val),
-#                "org": ' '.join(format(x, '02x') for x in val)
-            }
-            valList.append(recData)
+        for descriptor, value in self.getRecords():
+            valList.append(value_dict(descriptor, value, scaled))
         return valList
 
+    def getRecords(self):
+        """ Returns the decoded records as (descriptor, value) tuples
+
+        The descriptors are the interned WMBusRecordDescriptor objects shared
+        by all frames, thus no strings are copied per record.
+        """
+        values = decode_values(self.payload, self.get_decode_plan())
+        return [(rec.header.get_descriptor(), value) for rec, value in zip(self.records, values)]
+
+    def get_decode_plan(self):
+        """ Returns the (coding, offset, length) tuple of every record value
+
+        The offsets refer to self.payload. The plan is the input of
+        decode_values() which converts all values of the frame in one pass.
+        """
+        return [(rec.header.get_coding(), rec.offset, len(rec.value)) for rec in self.records]
+
     def is_without_tl(self):
         """ Returns True if the CI field indicates no transport layer
         """
@@ -22,8 +22,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from datetime import date, datetime, time
+from struct import Struct, calcsize
+
 from . import util
-from struct import unpack
+from .errors import RecordError
 
 def convert_from_bcd(bcd):
     """ Converts a bcd value to a decimal value
@@ -39,6 +45,451 @@ def convert_from_bcd(bcd):
         place *= 10
     return decimal
 
+# decimal value of every BCD byte, -1 if one of its nibbles is above 9
+BCD_TABLE = tuple(
+    (b >> 4) * 10 + (b & 0x0F) if (b >> 4) <= 9 and (b & 0x0F) <= 9 else -1
+    for b in range(256)
+)
+
+def decode_bcd(buffer, offset, length):
+    """ Decodes a little endian BCD value of length bytes at offset
+
+    A 0xF in the most significant nibble signals a negative value. Values
+    containing any other nibble above 9 (0xA ... 0xE, error codes according
+    to EN 13757-3) are returned as None.
+    """
+    if length <= 0:
+        return None
+
+    pos = offset + length - 1
+    msb = buffer[pos]
+    sign = 1
+
+    if msb >> 4 == 0xF:
+        sign = -1
+        msb &= 0x0F
+        value = msb if msb <= 9 else -1
+    else:
+        value = BCD_TABLE[msb]
+
+    if value < 0:
+        return None
+
+    while pos > offset:
+        pos -= 1
+        digits = BCD_TABLE[buffer[pos]]
+        if digits < 0:
+            return None
+        value = value * 100 + digits
+
+    return sign * value
+
+def _no_value(buffer, offset, length):
+    return None
+
+def _fixed(fmt):
+    """ Returns a decoder for a fixed width value using a precompiled Struct
+    """
+    unpack_from = Struct(fmt).unpack_from
+    size = calcsize(fmt)
+
+    def decode(buffer, offset, length):
+        if length < size:
+            return None
+        return unpack_from(buffer, offset)[0]
+    return decode
+
+def _fixed_split(fmt, shift):
+    """ Returns a decoder for 24 and 48 bit values (low part, signed high part)
+    """
+    unpack_from = Struct(fmt).unpack_from
+    size = calcsize(fmt)
+
+    def decode(buffer, offset, length):
+        if length < size:
+            return None
+        low, high = unpack_from(buffer, offset)
+        return (high << shift) | low
+    return decode
+
+def _bcd(size):
+    def decode(buffer, offset, length):
+        return decode_bcd(buffer, offset, min(size, length))
+    return decode
+
+@lru_cache(maxsize=1024)
+def convert_date_g(raw):
+    """ Converts a 16 bit type G value into a date (None if invalid)
+
+    Bits 0-4 day, bits 5-7 and 12-15 year (since 2000), bits 8-11 month
+    """
+    day = raw & 0x1F
+    month = (raw >> 8) & 0x0F
+    year = ((raw >> 5) & 0x07) | ((raw >> 9) & 0x78)
+
+    try:
+        return date(2000 + year, month, day)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=1024)
+def convert_datetime_f(raw, tz=None):
+    """ Converts a 32 bit type F value into a datetime (None if invalid)
+
+    Bits 0-5 minute, bit 7 invalid, bits 8-12 hour, bit 15 summer time,
+    bits 16-20 day, bits 21-23 and 28-31 year (since 2000), bits 24-27 month.
+    The meter sends its local time. Without tz a naive datetime is returned,
+    otherwise an aware datetime in the given time zone.
+    """
+    if raw & 0x80:
+        return None
+
+    minute = raw & 0x3F
+    hour = (raw >> 8) & 0x1F
+    day = (raw >> 16) & 0x1F
+    month = (raw >> 24) & 0x0F
+    year = ((raw >> 21) & 0x07) | ((raw >> 25) & 0x78)
+
+    try:
+        return datetime(2000 + year, month, day, hour, minute, tzinfo=tz)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=1024)
+def convert_datetime_i(raw, tz=None):
+    """ Converts a 48 bit type I value into a datetime (None if invalid)
+
+    Bits 0-5 second, bits 8-13 minute, bit 15 invalid, bits 16-20 hour,
+    bits 24-28 day, bits 29-31 and 36-39 year (since 2000), bits 32-35
+    month. The time zone is handled as for type F.
+    """
+    if raw & 0x8000:
+        return None
+
+    second = raw & 0x3F
+    minute = (raw >> 8) & 0x3F
+    hour = (raw >> 16) & 0x1F
+    day = (raw >> 24) & 0x1F
+    month = (raw >> 32) & 0x0F
+    year = ((raw >> 29) & 0x07) | ((raw >> 33) & 0x78)
+
+    try:
+        return datetime(2000 + year, month, day, hour, minute, second, tzinfo=tz)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=1024)
+def convert_time_j(raw):
+    """ Converts a 24 bit type J value into a time (None if invalid)
+
+    Bits 0-5 second, bits 8-13 minute, bits 16-20 hour
+    """
+    try:
+        return time((raw >> 16) & 0x1F, (raw >> 8) & 0x3F, raw & 0x3F)
+    except ValueError:
+        return None
+
+def _packed(fmt, shift, convert):
+    """ Returns a decoder which converts a bit packed date/time value
+    """
+    unpack_from = Struct(fmt).unpack_from
+    size = calcsize(fmt)
+
+    def decode(buffer, offset, length):
+        if length < size:
+            return None
+        values = unpack_from(buffer, offset)
+        raw = values[0] if len(values) == 1 else values[0] | (values[1] << shift)
+        return convert(raw)
+    return decode
+
+def lvar_length(lvar):
+    """ Returns the number of data bytes announced by an LVAR byte
+
+    00h-BFh ASCII string with LVAR characters
+    C0h-C9h positive BCD number with (LVAR-C0h)*2 digits
+    D0h-D9h negative BCD number with (LVAR-D0h)*2 digits
+    E0h-EFh binary number with (LVAR-E0h) bytes
+    F0h-FAh binary number with 4*(LVAR-ECh) bytes
+    FBh-FFh reserved
+    """
+    if lvar < 0xC0:
+        return lvar
+    if lvar < 0xE0:
+        return lvar & 0x0F
+    if lvar < 0xF0:
+        return lvar - 0xE0
+    if lvar <= 0xFA:
+        return 4 * (lvar - 0xEC)
+    return 0
+
+class WMBusVariableValue():
+    """ Variable length or manufacturer specific record data
+
+    The object references the data by a memoryview into the frame buffer.
+    Nothing is copied until the value is materialised by str(), bytes() or
+    materialise(). Strings are transmitted in reverse character order and
+    are returned in reading order. A pickled value (e.g. a result sent back
+    by a worker process) holds its own copy of the data.
+    """
+    __slots__ = ('kind', 'view')
+
+    TEXT = 'text'
+    BINARY = 'binary'
+    MANUFACTURER = 'manufacturer'
+
+    def __init__(self, kind, view):
+        self.kind = kind
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+    def materialise(self):
+        """ Returns the value as str (text) or bytes (binary data)
+        """
+        if self.kind == WMBusVariableValue.TEXT:
+            return self.view[::-1].tobytes().decode('latin-1')
+        return self.view.tobytes()
+
+    def __str__(self):
+        if self.kind == WMBusVariableValue.TEXT:
+            return self.materialise()
+        return self.view.hex()
+
+    def __repr__(self):
+        return "WMBusVariableValue(%s, %r)" % (self.kind, str(self))
+
+    def __reduce__(self):
+        return (_variable_value, (self.kind, self.view.tobytes()))
+
+def _variable_value(kind, data):
+    # unpickles a WMBusVariableValue from its copied data
+    return WMBusVariableValue(kind, memoryview(data))
+
+def decode_lvar(lvar, buffer, offset, length):
+    """ Decodes a variable length value according to its LVAR byte
+
+    BCD and binary numbers of up to 8 bytes are returned as int, strings and
+    longer binary data as WMBusVariableValue.
+    """
+    if lvar is None or lvar > 0xFA:
+        return None
+
+    if lvar < 0xC0:
+        return WMBusVariableValue(WMBusVariableValue.TEXT, memoryview(buffer)[offset:offset+length])
+
+    if lvar < 0xE0:
+        if (lvar & 0x0F) > 9:
+            return None
+        value = decode_bcd(buffer, offset, length)
+        if value is not None and lvar >= 0xD0:
+            value = -value
+        return value
+
+    if length <= 8:
+        return int.from_bytes(buffer[offset:offset+length], 'little', signed=True)
+
+    return WMBusVariableValue(WMBusVariableValue.BINARY, memoryview(buffer)[offset:offset+length])
+
+def _variable(buffer, offset, length):
+    # the LVAR byte precedes the value
+    return decode_lvar(buffer[offset-1], buffer, offset, length)
+
+def _manufacturer(buffer, offset, length):
+    return WMBusVariableValue(WMBusVariableValue.MANUFACTURER, memoryview(buffer)[offset:offset+length])
+
+# coding of manufacturer specific data (DIF 0Fh/1Fh)
+CODING_MANUFACTURER = 0x20
+
+# codings of date and time records (VIF 0x6C/0x6D), beyond the DIF data fields
+CODING_DATE_G = 0x10
+CODING_DATETIME_F = 0x11
+CODING_TIME_J = 0x12
+CODING_DATETIME_I = 0x13
+
+# value decoders by coding, called as decoder(buffer, offset, length)
+VALUE_DECODERS = {
+    0x0: _no_value,
+    0x1: _fixed('<B'),
+    0x2: _fixed('<h'),
+    0x3: _fixed_split('<Hb', 16),
+    0x4: _fixed('<i'),
+    0x5: _fixed('<f'),
+    0x6: _fixed_split('<Ih', 32),
+    0x7: _fixed('<q'),
+    0x8: _no_value,
+    0x9: _bcd(1),
+    0xA: _bcd(2),
+    0xB: _bcd(3),
+    0xC: _bcd(4),
+    0xD: _variable,
+    0xE: _bcd(6),
+    0xF: _no_value,
+    CODING_DATE_G: _packed('<H', 0, convert_date_g),
+    CODING_DATETIME_F: _packed('<I', 0, convert_datetime_f),
+    CODING_TIME_J: _packed('<HB', 16, convert_time_j),
+    CODING_DATETIME_I: _packed('<IH', 32, convert_datetime_i),
+    CODING_MANUFACTURER: _manufacturer
+}
+
+def decode_values(buffer, plan):
+    """ Decodes all values of a frame in one pass
+
+    The plan is a sequence of (coding, offset, length) tuples as returned by
+    WMBusFrame.get_decode_plan(), where coding selects the decoder from
+    VALUE_DECODERS and offset/length locate the value within buffer.
+    """
+    decoders = VALUE_DECODERS
+    return [decoders[coding](buffer, offset, length) for coding, offset, length in plan]
+
+# time units used by the duration VIFs (nn = 00 ... 11)
+TIME_UNITS = ('s', 'min', 'h', 'd')
+LONG_TIME_UNITS = ('h', 'd', 'month', 'a')
+
+def _units(table, base, quantity, unit, first_exponent, count):
+    """ Adds count consecutive VIF codes with increasing decimal exponent
+    """
+    for i in range(count):
+        table[base + i] = (quantity, unit, first_exponent + i)
+
+def _durations(table, base, quantity, units):
+    """ Adds consecutive VIF codes which only differ in their time unit
+    """
+    for i, unit in enumerate(units):
+        table[base + i] = (quantity, unit, 0)
+
+def _build_vif_units():
+    """ Returns the (quantity, unit, decimal exponent) table for all VIF codes
+
+    The table is keyed by the code returned from
+    WMBusDataRecordHeader.get_vif_code(): primary VIFs use their 7 bit value,
+    VIFs of the first (0xFB) and second (0xFD) extension table are prefixed
+    with the extension byte, e.g. 0xFD48 for "10⁻¹ V". Codes which do not
+    carry a physical unit (identification, dates, ...) have unit None.
+    """
+    table = {}
+
+    # primary VIF table
+    _units(table, 0x00, 'Energy', 'Wh', -3, 8)
+    _units(table, 0x08, 'Energy', 'J', 0, 8)
+    _units(table, 0x10, 'Volume', 'm³', -6, 8)
+    _units(table, 0x18, 'Mass', 'kg', -3, 8)
+    _durations(table, 0x20, 'On time', TIME_UNITS)
+    _durations(table, 0x24, 'Operating time', TIME_UNITS)
+    _units(table, 0x28, 'Power', 'W', -3, 8)
+    _units(table, 0x30, 'Power', 'J/h', 0, 8)
+    _units(table, 0x38, 'Volume flow', 'm³/h', -6, 8)
+    _units(table, 0x40, 'Volume flow', 'm³/min', -7, 8)
+    _units(table, 0x48, 'Volume flow', 'm³/s', -9, 8)
+    _units(table, 0x50, 'Mass flow', 'kg/h', -3, 8)
+    _units(table, 0x58, 'Flow temperature', '°C', -3, 4)
+    _units(table, 0x5C, 'Return temperature', '°C', -3, 4)
+    _units(table, 0x60, 'Temperature difference', 'K', -3, 4)
+    _units(table, 0x64, 'External temperature', '°C', -3, 4)
+    _units(table, 0x68, 'Pressure', 'bar', -3, 4)
+    table[0x6C] = ('Date', None, 0)
+    table[0x6D] = ('Date and time', None, 0)
+    table[0x6E] = ('Units for H.C.A.', '', 0)
+    _durations(table, 0x70, 'Averaging duration', TIME_UNITS)
+    _durations(table, 0x74, 'Actuality duration', TIME_UNITS)
+    table[0x78] = ('Fabrication no', None, 0)
+    table[0x79] = ('Enhanced identification', None, 0)
+    table[0x7A] = ('Address', None, 0)
+
+    # first extension table (0xFB)
+    _units(table, 0xFB00, 'Energy', 'Wh', 5, 2)
+    _units(table, 0xFB02, 'Reactive energy', 'varh', 3, 2)
+    _units(table, 0xFB08, 'Energy', 'J', 8, 2)
+    _units(table, 0xFB0C, 'Energy', 'cal', 5, 4)
+    _units(table, 0xFB10, 'Volume', 'm³', 2, 2)
+    _units(table, 0xFB14, 'Reactive power', 'var', 0, 4)
+    _units(table, 0xFB18, 'Mass', 'kg', 5, 2)
+    _units(table, 0xFB1A, 'Relative humidity', '%', -1, 2)
+    table[0xFB20] = ('Volume', 'ft³', 0)
+    table[0xFB21] = ('Volume', 'ft³', -1)
+    _units(table, 0xFB28, 'Power', 'W', 5, 2)
+    table[0xFB2A] = ('Phase U-U', '°', -1)
+    table[0xFB2B] = ('Phase U-I', '°', -1)
+    _units(table, 0xFB2C, 'Frequency', 'Hz', -3, 4)
+    _units(table, 0xFB30, 'Power', 'J/h', 8, 2)
+    _units(table, 0xFB74, 'Cold/warm temperature limit', '°C', -3, 4)
+    _units(table, 0xFB78, 'Cum. count max. power', 'W', -3, 8)
+
+    # second extension table (0xFD)
+    _units(table, 0xFD00, 'Credit', 'currency', -3, 4)
+    _units(table, 0xFD04, 'Debit', 'currency', -3, 4)
+    for code, quantity in (
+            (0x08, 'Unique telegram identification'),
+            (0x09, 'Device type'),
+            (0x0A, 'Manufacturer'),
+            (0x0B, 'Parameter set identification'),
+            (0x0C, 'Model / Version'),
+            (0x0D, 'Hardware version number'),
+            (0x0E, 'Metrology (firmware) version number'),
+            (0x0F, 'Other software version number'),
+            (0x10, 'Customer location'),
+            (0x11, 'Customer'),
+            (0x12, 'Access code user'),
+            (0x13, 'Access code operator'),
+            (0x14, 'Access code system operator'),
+            (0x15, 'Access code developer'),
+            (0x16, 'Password'),
+            (0x17, 'Error flags'),
+            (0x18, 'Error mask'),
+            (0x1A, 'Digital output'),
+            (0x1B, 'Digital input'),
+            (0x1F, 'Remote control'),
+            (0x20, 'First storage number for cyclic storage'),
+            (0x21, 'Last storage number for cyclic storage'),
+            (0x22, 'Size of storage block'),
+            (0x2A, 'Operator specific data'),
+            (0x30, 'Start of tariff'),
+            (0x3B, 'Data container for wireless M-Bus protocol'),
+            (0x62, 'Control signal'),
+            (0x63, 'Day of week'),
+            (0x64, 'Week number'),
+            (0x65, 'Time point of day change'),
+            (0x66, 'State of parameter activation'),
+            (0x67, 'Special supplier information'),
+            (0x70, 'Date and time of battery change'),
+            (0x72, 'Day light saving'),
+            (0x73, 'Listening window management'),
+            (0x76, 'Data container for manufacturer specific protocol')):
+        table[0xFD00 + code] = (quantity, None, 0)
+    table[0xFD1C] = ('Baud rate', 'Bd', 0)
+    table[0xFD1D] = ('Response delay time', 'bit times', 0)
+    table[0xFD1E] = ('Retry', '', 0)
+    _durations(table, 0xFD24, 'Storage interval', TIME_UNITS + ('month', 'a'))
+    table[0xFD2B] = ('Time point second', 's', 0)
+    _durations(table, 0xFD2C, 'Duration since last readout', TIME_UNITS)
+    _durations(table, 0xFD31, 'Duration of tariff', TIME_UNITS[1:])
+    _durations(table, 0xFD34, 'Period of tariff', TIME_UNITS + ('month', 'a'))
+    table[0xFD3A] = ('Dimensionless', '', 0)
+    _durations(table, 0xFD3C, 'Period of nominal data transmissions', TIME_UNITS)
+    _units(table, 0xFD40, 'Voltage', 'V', -9, 16)
+    _units(table, 0xFD50, 'Current', 'A', -12, 16)
+    table[0xFD60] = ('Reset counter', '', 0)
+    table[0xFD61] = ('Cumulation counter', '', 0)
+    _durations(table, 0xFD68, 'Duration since last cumulation', LONG_TIME_UNITS)
+    _durations(table, 0xFD6C, 'Operating time battery', LONG_TIME_UNITS)
+    table[0xFD71] = ('RF level', 'dBm', 0)
+    table[0xFD74] = ('Remaining battery life time', 'd', 0)
+    table[0xFD75] = ('Number times the meter was stopped', '', 0)
+
+    return table
+
+VIF_UNITS = _build_vif_units()
+
+# (multiplier, divisor) pairs to apply the decimal exponent without parsing
+VIF_SCALES = {
+    code: (10 ** exponent, 1) if exponent >= 0 else (1, 10 ** -exponent)
+    for code, (quantity, unit, exponent) in VIF_UNITS.items()
+}
+
 
 class WMBusDataRecordHeader():
         
@@ -51,31 +502,50 @@ class WMBusDataRecordHeader():
     def __init__(self, *args, **kwargs):
         self.dif = bytearray()
         self.vif = bytearray()
+        self.vif_text = None
+        self.vif_text_length = 0
+        self.lvar = None
+        self.value_offset = None
     
-    def parse(self, arr):
+    def parse(self, arr, offset=0):
         """ Parses the data head for valid dif/vif structure 
         
-        It returns the value part
+        The header is read from arr starting at offset. It returns the value
+        part, the offset of the value within arr is kept in value_offset.
+        Variable length values and manufacturer specific data are returned as
+        memoryview into arr, all other values as a copy.
         """ 
-        nr_difs = self.get_difs(arr)
-        nr_vifs = self.get_vifs(arr[nr_difs:])
+        nr_difs = self.get_difs(arr, offset)
+        
+        if self.is_manufacturer_specific():
+            # no VIF, the data reaches to the end of the user data
+            start = offset + nr_difs
+            self.value_offset = start
+            return memoryview(arr)[start:]
+        
+        nr_vifs = self.get_vifs(arr, offset+nr_difs)
         
         if len(self.dif) > WMBusDataRecordHeader.MAX_DIFS_AND_MAX_VIFS:
-            raise Exception("parse(): Nr. of DIFs exceeds specified length")
+            raise RecordError("parse(): Nr. of DIFs exceeds specified length")
         if len(self.vif) > WMBusDataRecordHeader.MAX_DIFS_AND_MAX_VIFS:
-            raise Exception("parse(): Nr. of VIFs exceeds specified length")
+            raise RecordError("parse(): Nr. of VIFs exceeds specified length")
         else:
             var = 0
             
             if (self.get_data_type() == WMBusDataRecordHeader.DATA_TYPE_VARIABLE):
                 var = 1
                 
-            start = nr_difs+nr_vifs+var
-            stop = start + self.get_data_len(arr)
+            start = offset+nr_difs+nr_vifs+self.vif_text_length+var
+            stop = start + self.get_data_len(arr, offset)
+            self.value_offset = start
+            
+            if var:
+                self.lvar = arr[start-1]
+                return memoryview(arr)[start:stop]
             
             return arr[start:stop]
     
-    def get_difs(self, arr):
+    def get_difs(self, arr, offset=0):
         """ Returns the number DIFs for the provided data
         
         Special functions
@@ -87,7 +557,7 @@ class WMBusDataRecordHeader():
         7Fh Global readout req (all storage nrs, units, tariffs, func. fields)
         """
         cnt = 0
-        dif = arr[cnt]
+        dif = arr[offset+cnt]
             
         # check whether the DIF signals a special function
         if dif in (0x0F, 0x1F, 0x2F, 0x7F) or dif >= 0x3F and dif <= 0x6F:
@@ -98,29 +568,41 @@ class WMBusDataRecordHeader():
         while (dif & 0x80) == 0x80:
             self.dif.append(dif)
             cnt += 1
-            dif = arr[cnt]
+            dif = arr[offset+cnt]
         
         # add final value
         self.dif.append(dif)
                         
         return cnt + 1
         
-    def get_vifs(self, arr):
+    def get_vifs(self, arr, offset=0):
         """ Returns the number of VIFs for the provided data
         """
         cnt = 0
-        vif = arr[cnt]
+        vif = arr[offset+cnt]
         
         # check whether the VIF has an extension (additional VIFs follow)
         while (vif & 0x80) == 0x80:
             self.vif.append(vif)
             cnt += 1
-            vif = arr[cnt]
+            vif = arr[offset+cnt]
             
         # add final value
         self.vif.append(vif)
         
+        # plain text VIF, the (reversed) ASCII unit follows the VIFEs
+        if (self.vif[0] & 0x7F) == 0x7C:
+            length = arr[offset+cnt+1]
+            text = arr[offset+cnt+2:offset+cnt+2+length]
+            self.vif_text = bytes(reversed(text)).decode('latin-1')
+            self.vif_text_length = 1 + length
+        
         return cnt + 1    
+
+    def is_manufacturer_specific(self):
+        """ Returns True if the DIF starts manufacturer specific data (0Fh, 1Fh)
+        """
+        return self.dif[0] in (0x0F, 0x1F)
         
     def get_data_type(self):
         """ Returns hints on the data type according to the DIF
@@ -136,7 +618,7 @@ class WMBusDataRecordHeader():
         else:
             return self.DATA_TYPE_FIXED
         
-    def get_data_len(self, arr):
+    def get_data_len(self, arr, offset=0):
         """ Returns the record value number of bytes 
         
         Note, that for unknown and variable length types, None is being
@@ -162,7 +644,7 @@ class WMBusDataRecordHeader():
             length of the variable value from the first byte of the actual
             value resp. from the first byte after the record header.
             '''
-            return arr[len(self.dif)+len(self.vif)+1]
+            return lvar_length(arr[offset+len(self.dif)+len(self.vif)+self.vif_text_length])
         else:
             return {
                 0x0: 0,
@@ -205,40 +687,38 @@ class WMBusDataRecordHeader():
         }.get(chooser)
     
 
+    def get_coding(self):
+        """ Returns the key of the value decoder in VALUE_DECODERS
+
+        This is the DIF data field, except for the date (type G) and date/time
+        (types F, J and I) VIFs which are decoded into date and time objects.
+        """
+        if self.is_manufacturer_specific():
+            return CODING_MANUFACTURER
+
+        field = self.dif[0] & 0x0F
+        vif = self.vif[0] & 0x7F
+
+        if vif == 0x6C and field == 0x2:
+            return CODING_DATE_G
+        if vif == 0x6D and self.vif[0] not in (0xFB, 0xFD):
+            return {
+                0x3: CODING_TIME_J,
+                0x4: CODING_DATETIME_F,
+                0x6: CODING_DATETIME_I
+            }.get(field, field)
+
+        return field
+
     def getDataValue(self, value):
-        chooser = self.dif[0] & 0x0F
-        if chooser == 0x0:
-            return None
-        elif chooser == 0x1:
-            return value[0]
-        elif chooser == 0x2:
-            return int.from_bytes(value[0:2],'little',signed=True)
-        elif chooser == 0x3:
-            return int.from_bytes(value[0:3],'little',signed=True)
-        elif chooser == 0x4:
-            return int.from_bytes(value[0:4],'little',signed=True)
-        elif chooser == 0x5:
-            return unpack('<f', value)[0]
-        elif chooser == 0x6:
-            return int.from_bytes(value[0:6],'little',signed=True)
-        elif chooser == 0x7:
-            return int.from_bytes(value[0:8],'little',signed=True)
-        elif chooser == 0x8:
-            return None
-        elif chooser == 0x9:
-            return convert_from_bcd(value[0])
-        elif chooser == 0xA:
-            return convert_from_bcd(int.from_bytes(value[0:2],'little',signed=False))
-        elif chooser == 0xB:
-            return convert_from_bcd(int.from_bytes(value[0:3],'little',signed=False))
-        elif chooser == 0xC:
-            return convert_from_bcd(int.from_bytes(value[0:4],'little',signed=False))
-        elif chooser == 0xD:
-            return None
-        elif chooser == 0xE:
-            return convert_from_bcd(int.from_bytes(value[0:6],'little',signed=False))
-        elif chooser == 0xF:
-            return None
+        """ Returns the decoded record value
+        """
+        coding = self.get_coding()
+        
+        if coding == 0xD:
+            return decode_lvar(self.lvar, value, 0, len(value))
+        
+        return VALUE_DECODERS[coding](value, 0, len(value))
 
     def get_function_field_name(self):
         """ Returns a speaking name for the DIF function field
@@ -446,6 +926,12 @@ class WMBusDataRecordHeader():
         E001 0001 – E111 1111	Reserved
         
         """
+        if self.vif_text is not None:
+            return self.vif_text
+        
+        if not self.vif:
+            return 'Manufacturer specific data'
+        
         extension = self.vif[0] & 0x80
         chooser = self.vif[0] & 0x7F
         
@@ -611,7 +1097,139 @@ class WMBusDataRecordHeader():
             0x7E: 'Any VIF',                                         # Used for readout selection of all VIF ́s (see 6.4)
             0x7F: 'Manufacturer specific'                            # VIFEs and data of this block are manufacturer specific
         }.get(chooser)
-            
+
+    def get_vif_code(self):
+        """ Returns a compact integer code for the VIF of this record
+
+        Primary VIFs map to their 7 bit value (0x00 ... 0x7F). VIFs from the
+        first and second extension table map to 0xFB00 resp. 0xFD00 plus the
+        7 bit value of the first VIFE. The code is the key of VIF_UNITS.
+        """
+        if not self.vif:
+            return 0x7F
+        
+        if self.vif[0] in (0xFB, 0xFD) and len(self.vif) > 1:
+            return (self.vif[0] << 8) | (self.vif[1] & 0x7F)
+
+        return self.vif[0] & 0x7F
+
+    def get_vif_unit(self):
+        """ Returns the (quantity, unit, decimal exponent) triple of the VIF
+
+        None is being returned for VIF codes which are not in VIF_UNITS.
+        """
+        return VIF_UNITS.get(self.get_vif_code())
+
+    def getScaledValue(self, value):
+        """ Returns the record value with the VIF decimal exponent applied
+
+        Values of VIFs without a physical unit and non numeric values are
+        returned unchanged.
+        """
+        value = self.getDataValue(value)
+        code = self.get_vif_code()
+        unit = VIF_UNITS.get(code)
+
+        if unit is None or unit[1] is None or not isinstance(value, (int, float)):
+            return value
+
+        multiplier, divisor = VIF_SCALES[code]
+        return float(value * multiplier) / divisor
+
+    def get_descriptor(self):
+        """ Returns the shared WMBusRecordDescriptor for the DIF/VIF bytes
+        """
+        return get_descriptor(self)
+
+class WMBusRecordDescriptor(namedtuple('WMBusRecordDescriptor',
+        'id key type sensor vif_code quantity unit exponent')):
+    """ Immutable description of a record header
+
+    Descriptors are interned by their DIF/VIF byte sequence (key) and are
+    created once per process. All records and meters using the same DIF/VIF
+    bytes share the same descriptor object and thus the same strings. The
+    id is a small integer which is unique within the process.
+    """
+    __slots__ = ()
+
+    def scale(self, value):
+        """ Returns value with the decimal exponent of the VIF applied
+        """
+        if self.unit is None or not isinstance(value, (int, float)):
+            return value
+
+        multiplier, divisor = VIF_SCALES[self.vif_code]
+        return float(value * multiplier) / divisor
+
+# interned descriptors by DIF/VIF bytes and by id
+_descriptors = {}
+_descriptors_by_id = []
+_descriptors_lock = threading.Lock()
+
+def get_descriptor(header):
+    """ Returns the interned descriptor for a parsed WMBusDataRecordHeader
+
+    Only the first sighting of a DIF/VIF combination creates a descriptor,
+    later lookups are a single dictionary access.
+    """
+    key = bytes(header.dif) + bytes(header.vif)
+    if header.vif_text is not None:
+        key += header.vif_text.encode('latin-1')
+    descriptor = _descriptors.get(key)
+
+    if descriptor is None:
+        with _descriptors_lock:
+            descriptor = _descriptors.get(key)
+            if descriptor is None:
+                vif_code = header.get_vif_code()
+                quantity, unit, exponent = VIF_UNITS.get(vif_code, (None, None, 0))
+                descriptor = WMBusRecordDescriptor(
+                    len(_descriptors_by_id),
+                    key,
+                    header.get_function_field_name(),
+                    header.get_vif_description(),
+                    vif_code,
+                    quantity,
+                    unit,
+                    exponent)
+                _descriptors_by_id.append(descriptor)
+                _descriptors[key] = descriptor
+
+    return descriptor
+
+def descriptor_by_id(id):
+    """ Returns the descriptor with the given process local id
+    """
+    return _descriptors_by_id[id]
+
+def descriptor_by_key(key):
+    """ Returns the descriptor for its DIF/VIF key (WMBusRecordDescriptor.key)
+
+    Used to map descriptor ids of another process (e.g. from a snapshot)
+    to the descriptors of this process.
+    """
+    descriptor = _descriptors.get(key)
+    if descriptor is not None:
+        return descriptor
+
+    header = WMBusDataRecordHeader()
+    offset = header.get_difs(key)
+    if not header.is_manufacturer_specific():
+        while True:
+            header.vif.append(key[offset])
+            offset += 1
+            if not header.vif[-1] & 0x80:
+                break
+        if (header.vif[0] & 0x7F) == 0x7C:
+            header.vif_text = bytes(key[offset:]).decode('latin-1')
+            header.vif_text_length = 1 + len(header.vif_text)
+    return get_descriptor(header)
+
+def descriptor_keys():
+    """ Returns the keys of all descriptors, indexed by descriptor id
+    """
+    return [descriptor.key for descriptor in list(_descriptors_by_id)]
+
 class WMBusDataRecord():
 
     def __init__(self):
@@ -624,17 +1242,16 @@ class WMBusDataRecord():
         further records to be processed in the returned array. If the 
         function fails, it throws an exception.
         """
+        return arr[self.parse_at(arr, 0):]
+
+    def parse_at(self, arr, offset):
+        """ Parses the record starting at offset of the provided bytearray
+
+        On success the offset of the next record is returned and the offset
+        of the record value within arr is stored in self.offset. If the
+        function fails, it throws an exception.
+        """
+        self.value = self.header.parse(arr, offset)
+        self.offset = self.header.value_offset
         
-        self.value = self.header.parse(arr)
-        
-        var = 0
-        
-        if (self.header.get_data_type() == WMBusDataRecordHeader.DATA_TYPE_VARIABLE):
-            var = 1
-            
-        len_dif = len(self.header.dif)
-        len_vif = len(self.header.vif)
-        
-        len_total = len_dif + len_vif + var + len(self.value)
-        
-        return arr[len_total:]
+        return self.offset + len(self.value)
@@ -22,7 +22,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from .wmbus import WMBusFrame
+import logging
+from collections import deque
+
+from .wmbus import WMBusFrame, peek_device_key, value_dict
+from .format_cache import WMBusFormatCache
+from .crc import strip_crc
+from .errors import error_category
+from .device_registry import DeviceRegistry
 
 # setup known keys dictionary by their device id
 keys = {
@@ -30,20 +37,300 @@ keys = {
     '\x00\x00\x00\x00': '\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF'
 }
 
-def interpret(telegram):
-    dataBytes = bytearray.fromhex(telegram['data'])
-    frame = WMBusFrame()
-    frame.parse(dataBytes, keys)
-    theData = {
-        "manufacturer": frame.get_manufacturer_short()[0:3].decode('UTF-8'),
-#        "manufacturer": frame.get_manufacturer_short(),
-        "serial": frame.getSerial(),
-        "data": frame.getValues()
-    }
-#    print(f"Mnf: {frame.get_manufacturer_short()}")
-#    print(f"Dev: {frame.get_device_id()}")
-#    print(f"FC: {frame.get_function_code()}")
-#    print(f"JSON: {frame.getValues()}")
-#    frame.log(2)
-    return theData
+# layouts of full frames, used to decode compact frames
+formats = WMBusFormatCache()
+
+class Interpreter():
+
+    def __init__(self, keys=None, formats=None, scaled=False, frame_format=None,
+                 filters=None, debug=None, name=None, log_level=None,
+                 breaker=None, dead_letters=None, index=None, registry=None, throttle=None):
+        """ Interprets gwmqtt telegrams with its own configuration and state
+
+        Every instance owns its key store, format signature cache, filters
+        and metrics. Several instances (e.g. one per tenant or per worker)
+        can be used side by side in one process. An instance itself is not
+        locked, it is meant to be used by one thread at a time.
+
+        keys maps device ids (4 bytes, big endian, as latin-1 string) to AES
+        keys, see WMBusFrame.parse(). filters is a list of callables which
+        are passed the parsed WMBusFrame and return False to drop it. debug
+        enables the WMBusFrame debug output, if it is None the module flag
+        wmbus.debug applies. Failures are logged to the logger
+        mqtt_wmbus_interpreter.wmbus_interpreter or, if a name is given, to
+        a child logger of that name. Its level is only set if log_level is
+        given, otherwise the logging configuration of the application
+        applies.
+
+        breaker takes a DeviceCircuitBreaker which stops decoding telegrams
+        of devices failing over and over, dead_letters a DeadLetterStore
+        which keeps samples of the failing telegrams. index takes a
+        LatestValueIndex which is updated with every interpreted frame
+        (except for streamed results). registry is the DeviceRegistry
+        resolving the identity of the sending devices, by default every
+        instance has its own. throttle takes a DeviceThrottle limiting the
+        rate of decoded telegrams per device. Only devices which were
+        decoded before are throttled, as they are registered once their
+        first frame was parsed. Held telegrams which became due are
+        interpreted by the next interpret() call and queued, callers
+        collect them with release_throttled() after every telegram and
+        when idle (ShardedDispatcher and interpret_into() do so).
+        """
+        self.keys = dict(keys) if keys else {}
+        self.formats = formats if formats is not None else WMBusFormatCache()
+        self.scaled = scaled
+        self.frame_format = frame_format
+        self.filters = list(filters) if filters else []
+        self.debug = debug
+        self.breaker = breaker
+        self.dead_letters = dead_letters
+        self.index = index
+        self.registry = registry if registry is not None else DeviceRegistry()
+        self.throttle = throttle
+        # results of released telegrams, see release_throttled()
+        self.released = deque()
+        self.logger = logging.getLogger(__name__ if name is None else "%s.%s" % (__name__, name))
+        if log_level is not None:
+            self.logger.setLevel(log_level)
+        self.metrics = {
+            "telegrams": 0,
+            "decoded": 0,
+            "filtered": 0,
+            "failed": 0,
+            "rejected": 0,
+            "held": 0,
+            "throttled": 0,
+            "errors": {}
+        }
+
+    def add_key(self, device_id, key):
+        """ Adds the AES key for a device
+
+        device_id is the device id as printed on the meter (8 hex digits,
+        e.g. '44000057'), key the 16 byte key as hex string.
+        """
+        devid = ''.join(chr(b) for b in bytes.fromhex(device_id))
+        self.keys[devid] = bytes.fromhex(key)
+
+    def parse(self, telegram, frame_format=None, lazy=False):
+        """ Returns the parsed WMBusFrame of a gwmqtt telegram
+
+        The telegram 'data' is either the hex string sent by the gateway or
+        the frame bytes (e.g. a memoryview into a SharedRingBuffer).
+
+        With lazy set the records are not parsed yet, see WMBusFrame.parse().
+        """
+        data = telegram['data']
+        dataBytes = bytearray.fromhex(data) if isinstance(data, str) else bytearray(data)
+        frame_format = self.frame_format if frame_format is None else frame_format
+        if frame_format:
+            dataBytes = strip_crc(dataBytes, frame_format)
+        frame = WMBusFrame() if self.debug is None else WMBusFrame(debug=self.debug)
+        # devices are registered once their first frame parsed successfully
+        if len(dataBytes) >= 10:
+            frame.identity = self.registry.identify(peek_device_key(dataBytes))
+        trace = telegram.get('trace')
+        if trace is not None and trace.sampled:
+            frame.trace = trace
+        frame.parse(dataBytes, self.keys, self.formats, lazy)
+        if frame.identity is not None and frame.identity.id is None:
+            frame.identity = self.registry.lookup(frame.identity.key)
+        return frame
+
+    def interpret(self, telegram, scaled=None, descriptors=False, frame_format=None, stream=False, released=False):
+        """ Interprets a gwmqtt telegram and returns the frame data
+
+        By default the records are returned as dictionaries (see
+        WMBusFrame.getValues()). With descriptors set they are returned as
+        (WMBusRecordDescriptor, value) tuples instead.
+        
+        If frame_format ('A' or 'B') is given, the telegram holds a raw frame
+        with CRC blocks. These are verified and stripped before the frame is
+        parsed, a CRCError is raised for corrupted frames.
+
+        With stream set "data" is a generator which parses and decodes the
+        records one at a time (see WMBusFrame.iter_values()). It can only be
+        consumed once. The telegram is counted as decoded resp. failed when
+        the generator is exhausted resp. raises. The filters are applied
+        before the records are parsed, i.e. they see the frame header only
+        and an empty list of records.
+
+        None is returned if one of the filters dropped the frame, the
+        circuit breaker rejected the device or the throttle held back the
+        telegram (counted in held; held telegrams replaced by a newer one
+        are counted in throttled). Held telegrams which are due are
+        interpreted first and their results queued for release_throttled().
+        released is set for telegrams handed out by the throttle, which are
+        neither throttled nor counted again as received. Failures are
+        counted per category (see errors.error_category()) and re-raised.
+
+        If the telegram carries a trace (see tracing.Tracer.begin()), the
+        time spent queued, parsing and interpreting is marked in it.
+        """
+        if not released:
+            self.metrics["telegrams"] += 1
+        trace = telegram.get('trace')
+        if trace is not None:
+            trace.mark('queue')
+        breaker = self.breaker
+        device = None
+        if not released and self.throttle is not None:
+            if self.throttle.pending:
+                self.release_due(scaled, descriptors, frame_format)
+            header = self.peek_header(telegram)
+            if len(header) == 10:
+                device = header[2:10]
+                identity = self.registry.get(device)
+                if identity is not None:
+                    throttle = self.throttle
+                    superseded = throttle.superseded
+                    admitted = throttle.admit(identity, header[1], telegram)
+                    # a held telegram of the device may have been replaced
+                    self.metrics["throttled"] += throttle.superseded - superseded
+                    if not admitted:
+                        self.metrics["held"] += 1
+                        return None
+        if breaker is not None or self.dead_letters is not None:
+            if device is None:
+                device = self.device_key(telegram)
+            if breaker is not None and not breaker.allow(device):
+                self.metrics["rejected"] += 1
+                return None
+
+        try:
+            frame = self.parse(telegram, frame_format, stream)
+        except Exception as e:
+            self.failed(telegram, device, e)
+            raise
+
+        if breaker is not None:
+            breaker.success(device)
+        if trace is not None and not trace.sampled:
+            trace.mark('parse')
+
+        for accept in self.filters:
+            if not accept(frame):
+                self.metrics["filtered"] += 1
+                return None
+
+        if scaled is None:
+            scaled = self.scaled
+        if stream:
+            data = self.stream(frame.iter_values(scaled, descriptors), telegram, device)
+        elif self.index is not None:
+            records = frame.getRecords()
+            self.index.update(frame, records)
+            data = records if descriptors else [value_dict(descriptor, value, scaled) for descriptor, value in records]
+        elif descriptors:
+            data = frame.getRecords()
+        else:
+            data = frame.getValues(scaled)
+        identity = frame.identity
+        theData = {
+            "manufacturer": identity.manufacturer,
+#            "manufacturer": frame.get_manufacturer_short(),
+            "serial": identity.serial,
+            "data": data
+        }
+#        print(f"Mnf: {frame.get_manufacturer_short()}")
+#        print(f"Dev: {frame.get_device_id()}")
+#        print(f"FC: {frame.get_function_code()}")
+#        print(f"JSON: {frame.getValues()}")
+#        frame.log(2)
+        if not stream:
+            self.metrics["decoded"] += 1
+        if trace is not None:
+            trace.mark('interpret')
+        return theData
+
+    def stream(self, records, telegram, device):
+        # yields the streamed records and books the telegram once consumed
+        try:
+            yield from records
+        except Exception as e:
+            self.failed(telegram, device, e)
+            raise
+        self.metrics["decoded"] += 1
+
+    def peek_header(self, telegram):
+        """ Returns the L, C, M and A fields of a telegram (10 bytes)
+
+        An empty or shorter bytes object is returned for broken telegrams.
+        """
+        data = telegram.get('data')
+        try:
+            if isinstance(data, str):
+                return bytes.fromhex(data[0:20])
+            return bytes(data[0:10])
+        except (TypeError, ValueError):
+            return b''
+
+    def device_key(self, telegram):
+        """ Returns the device key of a telegram from its link layer header
+        """
+        return peek_device_key(self.peek_header(telegram))
+
+    def release_throttled(self, scaled=None, descriptors=False, frame_format=None, now=None):
+        """ Returns the results of the held telegrams whose interval has passed
+
+        These are the results queued by interpret() and those of the held
+        telegrams which became due since. Failing telegrams are logged and
+        skipped (they are accounted like in interpret()).
+        """
+        if self.throttle is None:
+            return []
+        self.release_due(scaled, descriptors, frame_format, now)
+        results = list(self.released)
+        self.released.clear()
+        return results
+
+    def release_due(self, scaled, descriptors, frame_format, now=None):
+        # interprets the due held telegrams and queues their results
+        for telegram in self.throttle.release(now):
+            try:
+                result = self.interpret(telegram, scaled, descriptors, frame_format, released=True)
+            except Exception as e:
+                self.logger.warning("held telegram %s dropped: %s", telegram.get('data'), e)
+                continue
+            if result is not None:
+                self.released.append(result)
+
+    def failed(self, telegram, device, error):
+        # book a failed telegram in metrics, breaker and dead letter store
+        category = error_category(error)
+        self.metrics["failed"] += 1
+        errors = self.metrics["errors"]
+        errors[category] = errors.get(category, 0) + 1
+        self.logger.debug("telegram %s failed (%s): %s", telegram.get('data'), category, error)
+
+        if self.breaker is not None:
+            if self.breaker.failure(device):
+                self.logger.info("circuit of device %s opened (%s)", device.hex(), category)
+        if self.dead_letters is not None:
+            self.dead_letters.add(device, category, telegram, error)
+
+    def interpret_into(self, telegram, sink, scaled=None, descriptors=False, frame_format=None):
+        """ Interprets a telegram and streams the result into a sink
+
+        The sink's write() method is passed the result with "data" being a
+        generator, so the records are decoded while the sink consumes them.
+        The results of released throttled telegrams are written before it.
+        Returns False if the frame was filtered, True otherwise.
+        """
+        result = self.interpret(telegram, scaled, descriptors, frame_format, stream=True)
+        for released in self.release_throttled(scaled, descriptors, frame_format):
+            sink.write(released)
+        if result is None:
+            return False
+        sink.write(result)
+        return True
+
+# instance behind the module level interpret() function
+default_interpreter = Interpreter(keys, formats)
+# share the module key store, additions to keys apply to interpret()
+default_interpreter.keys = keys
 
+def interpret(telegram, scaled=False, descriptors=False, frame_format=None):
+    """ Interprets a gwmqtt telegram with the default Interpreter instance
+    """
+    return default_interpreter.interpret(telegram, scaled, descriptors, frame_format)
@@ -0,0 +1,33 @@
+import io
+import os
+import json
+import tempfile
+import unittest
+
+from mqtt_wmbus_interpreter.batch import decode_file
+
+# frames with a text LVAR record (0D13) resp. manufacturer specific data (0F)
+FRAMES = (
+    '1e442c2d010000001b077a010000000c13010000000d1303636261',
+    '21442c2d020000001b077a010000000c13020000000fdeadbeef01'
+)
+
+class DecodeFileTest(unittest.TestCase):
+
+    def test_variable_values_with_worker_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.hex')
+            with open(path, 'w') as f:
+                f.write('\n'.join(FRAMES * 3) + '\n')
+
+            output = io.StringIO()
+            count, failed = decode_file(path, output=output, jobs=2, chunk_size=1, progress=0)
+
+        self.assertEqual((count, failed), (6, 0))
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(results[0]["data"][1]["value"], 'abc')
+        self.assertEqual(results[1]["data"][1]["value"], 'deadbeef01')
+        self.assertEqual([result["serial"] for result in results], ['00000001', '00000002'] * 3)
+
+if __name__ == '__main__':
+    unittest.main()